@@ -1,14 +1,14 @@
 
-import boto3
-
 import json   # stl class for un/marshalling
-from typing import Union, Dict, List
+from typing import Union, Dict, List, Tuple
 from pathlib import Path
-import credentials
 
 import datetime
 from datetime import timezone
-import os, logging
+import os, re, logging, threading
+import numpy as np
+from storage import StorageBackend, createBackend
+from atomic_write import atomic_write
 
 logFilename = "logs/s3_log.log"
 logging.basicConfig(
@@ -20,33 +20,83 @@ logging.basicConfig(
     ]
 )
 
+##############################################################
+# User Config, the storage backend and bucket are configured in storage.py
+CONTENTS_KEY = "contents.json"
+CONTENTS_PATH = "./outputs/contents.json"  # Local copy of contents.json, updated by every run
+CONTENTS_PREFIXES = ["flow", "temperature", "archive"]  # Subdirectories listed in contents.json
+LEVEL_PREFIX = re.compile(r"(flow|temperature)_\d+m")    # Pyramid levels, e.g. flow_400m, are listed too
+##############################################################
+
+
+def isContentsPrefix(prefix: str) -> bool:
+    # True for the subdirectories whose objects are listed in contents.json and expire
+    return prefix in CONTENTS_PREFIXES or LEVEL_PREFIX.fullmatch(prefix) is not None
+
+
+def objectMetadata(localFilePath: str, fileName: str, etag: str, contentEncoding: str = None) -> Dict:
+    # metadata of an output file listed in contents.json
+    metadata = {
+        "size": os.path.getsize(localFilePath),
+        "time": os.path.splitext(fileName)[0],
+        "etag": etag,
+    }
+    if contentEncoding is not None:
+        # size is the decoded size, clients that are not browsers decode the body themselves
+        metadata["contentEncoding"] = contentEncoding
+    if fileName.endswith(".npy"):
+        # Only the header is read, decoding metadata of encoded frames is in encoding.json
+        with open(localFilePath, "rb") as f:
+            version = np.lib.format.read_magic(f)
+            readHeader = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+            shape, _, dtype = readHeader(f)
+        metadata["dtype"] = dtype.str
+        metadata["shape"] = list(shape)
+        metadata["encoding"] = {"f": f"float{dtype.itemsize * 8}", "i": f"int{dtype.itemsize * 8}"}.get(dtype.kind, dtype.name)
+    return metadata
+
 class S3:
 
-    def __init__(self) -> None:
-        self.__client = boto3.client(
-            service_name="s3",
-            region_name="us-west-2",
-            aws_access_key_id=credentials.aws_access_key_id,
-            aws_secret_access_key=credentials.aws_secret_access_key
-        )
-        self.__bucketName = "lake-tahoe-conditions"
+    def __init__(self, backend: StorageBackend = None) -> None:
+        """
+        Args:
+            backend (StorageBackend, optional): storage the outputs are published to, e.g. an
+                S3Backend with a client pointed at a local S3 stand-in or a LocalBackend.
+                Defaults to the STORAGE_BACKEND configured in storage.py
+
+        The backends are thread safe, a single S3 object can be shared by concurrent uploads.
+        """
+        if backend is None:
+            backend = createBackend()
+        self.__backend = backend
+        self.__bucketName = backend.bucketName
         self.__cwd = Path.cwd()
+        self.__listing = None  # prefix -> objects in the bucket, see listBucket
+        self.__contents = None  # contents.json, see getContents
+        self.__pendingContents = {}  # key -> metadata (None if deleted) of changes made before contents.json is loaded
+        self.__listingLock = threading.Lock()
         return
 
     def uploadToS3(self, localFilePath: str, fileName: str, flow: bool) -> Union[bool, Dict[str, str]]:
         # For testing use next 2 lines
         # testDir = "save_model_output_test/"
         # key = f"{testDir}flow/{fileName}" if flow else f"{testDir}temperature/{fileName}"
+        return self.uploadFile(localFilePath, f"flow/{fileName}" if flow else f"temperature/{fileName}")
+
+    def uploadArchive(self, localFilePath: str, fileName: str) -> Union[bool, Dict[str, str]]:
+        # uploads a run archive or its manifest into the archive subdirectory
+        return self.uploadFile(localFilePath, f"archive/{fileName}")
 
-        key = f"flow/{fileName}" if flow else f"temperature/{fileName}"
+    def contentEncoding(self, key: str) -> str:
+        # Content-Encoding an upload to key is stored with, None if it is stored as is
+        return self.__backend.contentEncoding(key)
 
-        response = self.__client.upload_file(
-            localFilePath,  # path to the file that is to be uploaded in the local machine
-            self.__bucketName,  # s3 bucket we will be adding the file to
-            Key=key,  # path in the s3 bucket to where the file should be stored
-        )
+    def uploadFile(self, localFilePath: str, key: str) -> Union[bool, Dict[str, str]]:
+        # uploads any output file to the given key, e.g. a pyramid level "flow_400m/2022-05-09 02.npy"
+        response = self.__backend.upload(localFilePath, key)
 
         if response == None:  # successful insertion into bucket
+            self.__recordUpload(localFilePath, key)
             message = {
                 "message": "successful",
                 "fileUploaded": localFilePath,
@@ -56,150 +106,249 @@ class S3:
 
             logging.info(message)
             return True, message
-        
-        message = {
-            "message": "successful",
-            "fileUploaded": localFilePath,
-            "bucketName": self.__bucketName,
-            "locationInBucket": key,
-        }
 
-        logging.warning(message)  # this request failed       
+        logging.warning(f"Failed to upload {localFilePath} to {key}")
         return False, {"message": "failed"}
 
-    def __insertToBucket(self, localFilePath: str, fileName: str) -> Union[bool, Dict[str, str]]:
-        # inserts files to bucket (not into a subdirectory)
-        response = self.__client.upload_file(
-            localFilePath,  # path to the file that is to be uploaded in the local machine
-            self.__bucketName,  # s3 bucket we will be adding the file to
-            Key=fileName,  # path in the s3 bucket to where the file should be stored
-        )
-    
-        if response == None:  # successful insertion into bucket
-            message = {
-                "message": "successful",
-                "fileUploaded": localFilePath,
-                "bucketName": self.__bucketName,
-                "locationInBucket": fileName,
+    def getContents(self) -> Dict[str, Union[List[str], Dict[str, Dict]]]:
+        """
+        Returns contents.json, the index of the flow, temperature, archive and pyramid level
+        objects in the bucket
+
+        ```
+        {
+            "flow": ["2022-05-09 02.npy", ...],
+            "temperature": [...],
+            "archive": [...],
+            "flow_400m": [...],
+            "objects": {
+                "flow/2022-05-09 02.npy": {"size": 142208, "time": "2022-05-09 02", "etag": "...",
+                                           "dtype": "<f4", "shape": [2, 174, 102], "encoding": "float32"},
+                ...
             }
-            return True, message
-
-        return False, {"message": "failed"}
+        }
+        ```
 
-    def getContents(self) -> Dict[str, List[str]]:
-        # check if contents.json exists
-        key: str = "contents.json"
-        result: Dict[str, str] = self.__client.list_objects_v2(Bucket=self.__bucketName, Prefix=key)
-
-        self.prettyPrint(result, title="Key Bucket Query Result:")
-
-        contentsJSON: Dict[str, List[str]] = None
-        prefixPath = "./outputs"
-        fileLocation = f"{prefixPath}/{key}"
-
-        if 'Contents' in result:
-            logging.info(f"{key} exists in the bucket.")
-
-            # retreive contents.json
-            self.__client.download_file(
-                self.__bucketName,  # 'BUCKET_NAME'
-                key,  # 'OBJECT_NAME'
-                fileLocation  # 'FILE_NAME' destination to download file to
-            )
-            
-            # load file into a json object
-            f = open(fileLocation)
-            contentsJSON = json.load(f)
+        The index is loaded once, from the local copy written by the last updateContents, else
+        from the bucket. It is then kept up to date by the uploads and deletes made through this
+        object. The bucket is only listed to build an index from scratch.
+        """
+        with self.__listingLock:
+            contentsJSON = self.__contents
+        if contentsJSON is not None:
+            return contentsJSON
+
+        contentsJSON = None
+        if os.path.isfile(CONTENTS_PATH):
+            with open(CONTENTS_PATH) as f:
+                contentsJSON = json.load(f)
+            logging.info(f"Loaded {CONTENTS_KEY} from {CONTENTS_PATH}")
         else:
-            logging.info(f"{key} doesn't exist in the bucket.")
-
-            # if it doesn't make a contents.json for the first time and insert to bucket
+            data = self.__backend.get(CONTENTS_KEY)
+            if data is not None:
+                contentsJSON = json.loads(data)
+                logging.info(f"Downloaded {CONTENTS_KEY} from {self.__bucketName}")
+            else:
+                logging.info(f"{CONTENTS_KEY} doesn't exist in the bucket.")
+
+        if contentsJSON is None or "objects" not in contentsJSON:
+            # First run, or an index written before object metadata was tracked
             contentsJSON = self.__createContents()
 
-            # create and store json
-            with open(fileLocation, "w") as f:
-                json.dump(contentsJSON, f)
-
-            # insert contents.json into s3 bucket
-            self.__insertToBucket(localFilePath=fileLocation, fileName=key)
-
-        # logging contents.json
-        logMsg = f"contents.json: \n{contentsJSON}"
-        logging.info(logMsg)
-
-        # return contents.json after parsing into Dict[str, List[str]]
-        return contentsJSON
+        with self.__listingLock:
+            if self.__contents is None:
+                self.__contents = contentsJSON
+                # e.g. frames uploaded while si3d was running
+                for key, metadata in self.__pendingContents.items():
+                    self.__applyToContents(key, metadata)
+                self.__pendingContents = {}
+            return self.__contents
 
     def updateContents(self) -> Union[bool, Dict[str, str]]:
         """
         Approach: 
-        1.) create and update contents.json
-        2.) upload back to s3 bucket
+        1.) delete predictions over 2 weeks old from the bucket
+        2.) write contents.json from the index kept up to date by this run's uploads and deletes
+        3.) upload it back to s3 bucket, without listing the bucket
 
         Warning: 
         this function must be used after uploading all files to the s3 bucket
         """
 
-        prefixPath = "./outputs"
-
-        # Remove old predictions from bucket
-        for objType in ["temperature", "flow"]:
-            response = self.__client.list_objects_v2(Bucket=self.__bucketName, Prefix=objType)
-            objs = response.get("Contents")
-
-            if objs == None:
-                # No predictions for this type
-                continue
-
-            for obj in objs:
-                # Delete predictions over 2 weeks old
-                _, fileName = obj["Key"].split('/')
-                objDate = datetime.datetime.strptime(fileName, "%Y-%m-%d %H.npy")
-                # Predictions are made in the UTC timezone
-                objDate = objDate.replace(tzinfo=timezone.utc)
-                twoWeeksAgo = datetime.datetime.now(tz=timezone.utc) - datetime.timedelta(weeks=2)
-                if objDate >= twoWeeksAgo:
-                    continue
-                
-                logging.info(f"Deleting {obj['Key']}...")
-                self.deleteObject(obj["Key"])
-                
-                # Delete local copy of old prediction
-                os.remove(f"{prefixPath}/{obj['Key']}")
-
-        # get new contents.json
-        contentsJSON = self.__createContents()
-
-        key = "contents.json"
-
-        fileLocation = f"{prefixPath}/{key}"
+        # Remove predictions over 2 weeks old from bucket
+        # Predictions are made in the UTC timezone
+        twoWeeksAgo = datetime.datetime.now(tz=timezone.utc) - datetime.timedelta(weeks=2)
+        objects = self.getContents()["objects"]
+        expiredKeys = []
+        for key, metadata in list(objects.items()):
+            objDate = datetime.datetime.strptime(metadata["time"], "%Y-%m-%d %H")
+            objDate = objDate.replace(tzinfo=timezone.utc)
+            if objDate < twoWeeksAgo:
+                expiredKeys.append(key)
+
+        if len(expiredKeys) > 0:
+            logging.info(f"Deleting {len(expiredKeys)} predictions older than {twoWeeksAgo:%Y-%m-%d %H}...")
+            deletedKeys, errors = self.deleteObjects(expiredKeys)
+            logging.info(f"Deleted {len(deletedKeys)} predictions, {len(errors)} failed")
 
         # create and store json
-        with open(fileLocation, "w") as f:
-            json.dump(contentsJSON, f)
+        with self.__listingLock:
+            data = json.dumps(self.__contents).encode()
+            nObjects = len(self.__contents["objects"])
+        with atomic_write(CONTENTS_PATH, "wb") as f:
+            f.write(data)
 
-        # if testing uncomment next lines
-        # key = "save_model_output_test/contents.json"
+        # insert contents.json into s3 bucket
+        response = self.__backend.putIndex(CONTENTS_KEY, data)
 
-        logMsg = f"Updated contents.json \n{contentsJSON}"
+        logMsg = f"Updated contents.json with {nObjects} objects"
         logging.info(logMsg)
 
-        # insert contents.json into s3 bucket
-        return self.__insertToBucket(localFilePath=fileLocation, fileName=key)
+        if response == None:  # successful insertion into bucket
+            message = {
+                "message": "successful",
+                "fileUploaded": CONTENTS_PATH,
+                "bucketName": self.__bucketName,
+                "locationInBucket": CONTENTS_KEY,
+            }
+            return True, message
 
-    def __createContents(self) -> Dict[str, List[str]]:
-        contents = {
-            "flow": self.getAllFlowFilesFromBucket(),
-            "temperature": self.getAllTemperatureFilesFromBucket()
-        }
+        return False, {"message": "failed"}
+
+    def __createContents(self) -> Dict[str, Union[List[str], Dict[str, Dict]]]:
+        # builds the index from a listing of the bucket
+        contents = {prefix: [] for prefix in CONTENTS_PREFIXES}
+        contents["objects"] = {}
+        listing = self.listBucket()
+        for prefix in CONTENTS_PREFIXES + sorted(p for p in listing if LEVEL_PREFIX.fullmatch(p)):
+            contents.setdefault(prefix, [])
+            for obj in listing.get(prefix, []):
+                fileName = obj["Key"][len(prefix) + 1:]
+                contents[prefix].append(fileName)
+                contents["objects"][obj["Key"]] = {
+                    "size": obj["Size"],
+                    "time": os.path.splitext(fileName)[0],
+                    "etag": obj.get("ETag"),
+                }
         return contents
 
-    # TODO: not sure how to check if the request failed
     def deleteObject(self, objKey):
-        self.__client.delete_object(Bucket=self.__bucketName, Key=objKey)
+        errors = self.__backend.deleteMany([objKey])
+        if objKey in errors:
+            logging.error(f"Failed to delete {objKey} from {self.__bucketName}, {errors[objKey]}")
+            return
+        self.__recordDelete(objKey)
         logMsg = f"Deleted {objKey} from {self.__bucketName}"
         logging.info(logMsg)  # log deletion
 
+    def deleteObjects(self, objKeys: List[str], prefixPath: str = "./outputs") -> Tuple[List[str], Dict[str, str]]:
+        """
+        Deletes objects from the bucket (S3 in batches of up to 1000 keys per request), and
+        their local copies in prefixPath
+
+        Args:
+            objKeys (List[str]): keys of the objects to delete
+            prefixPath (str, optional): local directory mirroring the bucket, None to keep local copies
+
+        Returns:
+            List[str]: keys that were deleted
+            Dict[str, str]: error message of every key that could not be deleted
+        """
+        errors = self.__backend.deleteMany(objKeys)
+        for key, error in errors.items():
+            logging.error(f"Failed to delete {key} from {self.__bucketName}, {error}")
+
+        deletedKeys = []
+        for key in objKeys:
+            if key in errors:
+                continue
+            deletedKeys.append(key)
+            self.__recordDelete(key)
+
+            # Delete local copy of old prediction
+            if prefixPath is not None and os.path.isfile(f"{prefixPath}/{key}"):
+                os.remove(f"{prefixPath}/{key}")
+        return deletedKeys, errors
+
+    def listBucket(self, refresh: bool = False) -> Dict[str, List[Dict]]:
+        """
+        Returns every object in the bucket, grouped by prefix (the directory before the first '/',
+        "" for objects at the root of the bucket)
+
+        The bucket is listed once (page by page for S3) and cached in this object. Uploads and
+        deletes made through this object keep the cached listing up to date.
+
+        Args:
+            refresh (bool, optional): list the bucket again instead of using the cached listing
+        """
+        with self.__listingLock:
+            if self.__listing is None or refresh:
+                listing: Dict[str, List[Dict]] = {}
+                for obj in self.__backend.list():
+                    listing.setdefault(self.__prefixOf(obj["Key"]), []).append(obj)
+                self.__listing = listing
+
+                nObjects = sum(len(objs) for objs in listing.values())
+                logging.info(f"Listed {nObjects} objects in {self.__bucketName}")
+            return self.__listing
+
+    def __recordUpload(self, localFilePath: str, key: str) -> None:
+        # keeps the cached listing and contents.json up to date
+        prefix = self.__prefixOf(key)
+        etag = self.__backend.etag(localFilePath)
+        metadata = None
+        if isContentsPrefix(prefix):
+            metadata = objectMetadata(localFilePath, key[len(prefix) + 1:], etag, self.__backend.contentEncoding(key))
+
+        with self.__listingLock:
+            if self.__listing is not None:
+                objs = self.__listing.setdefault(prefix, [])
+                objs[:] = [obj for obj in objs if obj["Key"] != key]
+                objs.append({
+                    "Key": key,
+                    "Size": os.path.getsize(localFilePath),
+                    "LastModified": datetime.datetime.now(tz=timezone.utc),
+                    "ETag": etag,
+                })
+
+            if metadata is not None:
+                self.__applyToContents(key, metadata)
+
+    def __recordDelete(self, key: str) -> None:
+        prefix = self.__prefixOf(key)
+        with self.__listingLock:
+            if self.__listing is not None:
+                objs = self.__listing.get(prefix, [])
+                objs[:] = [obj for obj in objs if obj["Key"] != key]
+
+            if isContentsPrefix(prefix):
+                self.__applyToContents(key, None)
+
+    def __applyToContents(self, key: str, metadata: Dict) -> None:
+        # adds (or removes if metadata is None) an object of contents.json, called with the lock held
+        if self.__contents is None:
+            self.__pendingContents[key] = metadata
+            return
+
+        prefix = self.__prefixOf(key)
+        fileName = key[len(prefix) + 1:]
+        if metadata is None:
+            if key in self.__contents["objects"]:
+                del self.__contents["objects"][key]
+                if fileName in self.__contents.get(prefix, []):
+                    self.__contents[prefix].remove(fileName)
+            return
+
+        if key not in self.__contents["objects"]:
+            # Pyramid levels get their list on their first upload
+            self.__contents[prefix] = sorted(self.__contents.get(prefix, []) + [fileName])
+        self.__contents["objects"][key] = metadata
+
+    @staticmethod
+    def __prefixOf(key: str) -> str:
+        index = key.find("/")
+        return "" if index == -1 else key[:index]
+
     def getAllFlowFilesFromDRS(self) -> List[str]:
         # return a list of filenames for objects in Flow Subdirectory in DRS
         return os.listdir(f"{self.__cwd}/outputs/flow")
@@ -217,18 +366,8 @@ class S3:
         return self.getObjectsByKey("temperature")
 
     def getObjectsByKey(self, key: str) -> List[str]:
-        # gets all the objects with the matching prefix(inputted key)
-        objectsInBucket = []
-        response = self.__client.list_objects_v2(Bucket=self.__bucketName)
-        for obj in response['Contents']:
-            objName = obj["Key"]
-            index = objName.find("/")
-            if index == -1:  # index is not found
-                continue
-            dirName = objName[:index]  
-            fileName = objName[index + 1:]
-            if dirName == key:
-                objectsInBucket.append(fileName)
+        # gets all the objects with the matching prefix(inputted key), from the cached listing
+        objectsInBucket = [obj["Key"][len(key) + 1:] for obj in self.listBucket().get(key, [])]
         
         # log results
         logMsg = f"Objects in Bucket with key: {key} \n{objectsInBucket}"
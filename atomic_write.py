@@ -0,0 +1,36 @@
+""" The purpose of this file is to write files that other processes or later runs read, e.g.
+caches, manifests and indexes, without ever leaving a partially written file behind.
+
+Example Usage:
+>>> from atomic_write import atomic_write
+>>> with atomic_write(path, "w") as f:
+...     json.dump(data, f)
+"""
+
+from contextlib import contextmanager
+import os
+
+# Suffix of the temporary file, next to the file being written
+PARTIAL_SUFFIX = ".part"
+
+
+@contextmanager
+def atomic_write(path, mode="w"):
+    """ Opens a temporary file next to path, and renames it to path once the block completes
+
+    Readers see either the previous file or the complete new one. If the block raises, the
+    temporary file is removed and path is left as it was.
+
+    Args:
+        path (str): file to write
+        mode (str, optional): mode the temporary file is opened with, e.g. "w" or "wb"
+    """
+    partial_path = path + PARTIAL_SUFFIX
+    try:
+        with open(partial_path, mode) as f:
+            yield f
+    except BaseException:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+    os.replace(partial_path, path)
@@ -0,0 +1,71 @@
+"""
+Use this script to choose UPLOAD_COMPRESSION and UPLOAD_COMPRESSION_LEVEL in storage.py.
+- For every Content-Encoding and level, reports the compression ratio and the compress and
+decompress throughput over the frames in outputs/flow and outputs/temperature.
+
+Create the frames first with `python -m model.create_output_binary`, then run from the root
+of the repository:
+
+`python benchmark_compression.py`
+"""
+
+import os
+import time
+import argparse
+from storage import CONTENT_ENCODINGS, zstandard
+
+LEVELS = {
+    "gzip": [1, 3, 6, 9],
+    "zstd": [1, 3, 9, 19],
+}
+
+
+def read_frames(outputs_dir):
+    frames = {}
+    for field in ("flow", "temperature"):
+        directory = os.path.join(outputs_dir, field)
+        if not os.path.isdir(directory):
+            continue
+        for file_name in sorted(os.listdir(directory)):
+            if file_name.endswith(".npy"):
+                with open(os.path.join(directory, file_name), "rb") as f:
+                    frames.setdefault(field, []).append(f.read())
+    return frames
+
+
+def benchmark(field, frames, encoding, level):
+    compress, decompress, _ = CONTENT_ENCODINGS[encoding]
+    n_bytes = sum(len(frame) for frame in frames)
+
+    start = time.perf_counter()
+    encoded = [compress(frame, level) for frame in frames]
+    compress_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    decoded = [decompress(frame) for frame in encoded]
+    decompress_time = time.perf_counter() - start
+    assert decoded == frames, f"{encoding} level {level} changed the frames"
+
+    n_encoded = sum(len(frame) for frame in encoded)
+    print(f"{field:<13}{encoding:<6}{level:>6}{n_bytes / len(frames):>14.0f}{n_encoded / len(frames):>14.0f}"
+          f"{n_bytes / n_encoded:>8.2f}{n_bytes / 1e6 / compress_time:>14.1f}{n_bytes / 1e6 / decompress_time:>16.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares the Content-Encodings of uploaded frames")
+    parser.add_argument("--outputs", default="./outputs", help="directory with the flow and temperature frames")
+    args = parser.parse_args()
+
+    frames = read_frames(args.outputs)
+    if len(frames) == 0:
+        print(f"No frames in {args.outputs}/flow or {args.outputs}/temperature, run `python -m model.create_output_binary` first")
+        raise SystemExit(1)
+
+    print(f"{'field':<13}{'codec':<6}{'level':>6}{'bytes/frame':>14}{'encoded':>14}{'ratio':>8}{'compress MB/s':>14}{'decompress MB/s':>16}")
+    for field, field_frames in frames.items():
+        for encoding, levels in LEVELS.items():
+            if encoding == "zstd" and zstandard is None:
+                print(f"{field:<13}zstd  skipped, pip install zstandard")
+                continue
+            for level in levels:
+                benchmark(field, field_frames, encoding, level)
@@ -0,0 +1,109 @@
+"""
+Use this script to measure the publish throughput of save_model_output without network,
+with one upload at a time and with concurrent uploads.
+
+By default S3 is emulated in process by moto (`pip install moto`), with a simulated round
+trip time added to every request. Pass --endpoint-url to use a moto server
+(`moto_server -p 5000`) or any other S3 compatible endpoint instead, or --backend local to
+publish to a local directory (storage.LocalBackend).
+
+Run from the root of the repository:
+
+`python benchmark_upload.py --workers 1 8 --latency 0.05`
+`python benchmark_upload.py --backend local`
+"""
+
+import os
+import time
+import argparse
+import datetime
+import tempfile
+import boto3
+import numpy as np
+from botocore.config import Config
+import S3
+import storage
+import save_model_output
+
+DAYS = 8                  # Frames uploaded by a run, older frames are skipped by save_model_output
+FRAMES_PER_DAY = 12
+GRID_SHAPE = (174, 102)
+
+
+def write_synthetic_outputs(n_frames):
+    """ Writes flow and temperature frames dated from now on into ./outputs """
+    os.makedirs("outputs/flow")
+    os.makedirs("outputs/temperature")
+    start = datetime.datetime.now(datetime.timezone.utc).replace(minute=0, second=0, microsecond=0)
+    rng = np.random.default_rng(0)
+    for idx in range(n_frames):
+        timestamp = (start + datetime.timedelta(hours=2 * idx)).strftime("%Y-%m-%d %H")
+        np.save(f"outputs/flow/{timestamp}.npy", rng.random((2,) + GRID_SHAPE, dtype=np.float32))
+        np.save(f"outputs/temperature/{timestamp}.npy", rng.random(GRID_SHAPE, dtype=np.float32))
+
+
+def create_s3_backend(endpointUrl, latency):
+    client = boto3.client(
+        service_name="s3",
+        region_name="us-west-2",
+        endpoint_url=endpointUrl,
+        aws_access_key_id="testing",
+        aws_secret_access_key="testing",
+        config=Config(max_pool_connections=storage.MAX_POOL_CONNECTIONS)
+    )
+    if latency > 0:
+        # Every request waits like it would on the network
+        client.meta.events.register("before-send.s3", lambda **kwargs: time.sleep(latency))
+    client.create_bucket(Bucket=storage.BUCKET_NAME, CreateBucketConfiguration={"LocationConstraint": "us-west-2"})
+    return storage.S3Backend(client)
+
+
+def benchmark(workers, backend):
+    # Every run starts without index nor sync manifest, like the first run on a new bucket
+    for path in (S3.CONTENTS_PATH, save_model_output.SYNC_MANIFEST_PATH):
+        if os.path.isfile(path):
+            os.remove(path)
+    s3 = S3.S3(backend)
+
+    start = time.perf_counter()
+    save_model_output.save_model_output(s3, workers=workers)
+    elapsed = time.perf_counter() - start
+
+    keys = [obj["Key"] for obj in backend.list()]
+    nBytes = sum(os.path.getsize(f"outputs/{key}") for key in keys if key != S3.CONTENTS_KEY)
+    print(f"{workers:>8} workers {len(keys):>6} objects {elapsed:>8.2f} s {nBytes / 1e6 / elapsed:>8.2f} MB/s")
+
+    # Leave an empty bucket for the next run
+    backend.deleteMany(keys)
+    return elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures save_model_output upload throughput")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, save_model_output.UPLOAD_WORKERS])
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds added to every request")
+    parser.add_argument("--endpoint-url", default=None, help="S3 compatible endpoint, moto in process by default")
+    parser.add_argument("--backend", choices=["s3", "local"], default="s3", help="storage backend to publish to")
+    args = parser.parse_args()
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmpDir:
+        os.chdir(tmpDir)
+        write_synthetic_outputs(DAYS * FRAMES_PER_DAY)
+        try:
+            if args.backend == "local":
+                backend = storage.LocalBackend(os.path.join(tmpDir, "bucket"))
+                times = [benchmark(workers, backend) for workers in args.workers]
+            elif args.endpoint_url is None:
+                from moto import mock_aws
+                with mock_aws():
+                    backend = create_s3_backend(None, args.latency)
+                    times = [benchmark(workers, backend) for workers in args.workers]
+            else:
+                backend = create_s3_backend(args.endpoint_url, args.latency)
+                times = [benchmark(workers, backend) for workers in args.workers]
+        finally:
+            os.chdir(cwd)
+
+    for workers, elapsed in zip(args.workers[1:], times[1:]):
+        print(f"speedup with {workers} workers: {times[0] / elapsed:.1f}x")
@@ -5,11 +5,17 @@ Note: all timestamps are in UTC
 """
 
 from bisect import bisect_left
-from collections import defaultdict
+from functools import partial
+from dataretrieval.fetch import fetch_concurrently, raise_errors
+from dataretrieval.sessions import get_session, REQUEST_TIMEOUT
+from atomic_write import atomic_write
 import numpy as np
 import pandas as pd
 import datetime
-import requests
+import threading
+import logging
+import json
+import os
 
 ENDPOINTS = {
     'USCG': "https://tepfsail50.execute-api.us-west-2.amazonaws.com/v1/report/met-uscg2020",
@@ -27,14 +33,33 @@ NASA_BUOY_ID = 4
 # Multiple nearshore stations with ID's 1-9
 NEAR_SHORE_ID = 9
 
+## On-disk cache of the station data
+
+# Set to False to always request every day from the endpoints
+USE_CACHE = True
+# One json file per endpoint, station and UTC day: CACHE_DIR/<endpoint>/<id>/<YYYY-MM-DD>.json
+CACHE_DIR = "./cache/aws/"
+# Samples can arrive a little after the end of their day, so a day is only cached
+# once it was fetched this long after it ended
+CACHE_SETTLE_TIME = datetime.timedelta(hours=1)
+
+# Days served from the cache (hits), days requested from the endpoints (misses), and requests sent
+cache_stats = {'hits': 0, 'misses': 0, 'requests': 0}
+cache_stats_lock = threading.Lock()
+
+
 """
+Sends a single request to an AWS endpoint, without the cache
+
 Args:
     url (str): endpoint url
     station (int): station id
     start_date (datetime): starting date of query
     end_date (datetime, optional): end date of query.
+Returns:
+    list of data samples, empty if the endpoint returned nothing
 """
-def get_endpoint_json(url, id, start_date, end_date=None):
+def request_endpoint_json(url, id, start_date, end_date=None):
     # Set GET request parameters
     format_date = lambda date: date.strftime("%Y%m%d")
     params = {
@@ -45,17 +70,126 @@ def get_endpoint_json(url, id, start_date, end_date=None):
     if end_date is not None:
         params['rptend'] = format_date(end_date)
 
-    # Send request and return data in JSON format
-    response = requests.get(url, params=params)
+    # Send request over the shared keep-alive connections and return data in JSON format
+    response = get_session().get(url, params=params, timeout=REQUEST_TIMEOUT)
+    with cache_stats_lock:
+        cache_stats['requests'] += 1
 
     response_json = response.json()
-    if response_json is None or len(response_json) == 0:
-        raise Exception(f"AWS endpoint failed: {response.url}")
+    if response_json is None:
+        return []
 
     return response_json
 
 
+"""
+Returns the data of the endpoint for every day from start_date to end_date. Completed
+past days are served from CACHE_DIR, the other days are requested from the endpoint
+and cached once they are complete.
+
+Args:
+    url (str): endpoint url
+    station (int): station id
+    start_date (datetime): starting date of query
+    end_date (datetime, optional): end date of query. Only the day of start_date if None
+"""
+def get_endpoint_json(url, id, start_date, end_date=None):
+    if not USE_CACHE:
+        response_json = request_endpoint_json(url, id, start_date, end_date=end_date)
+        if len(response_json) == 0:
+            raise Exception(f"AWS endpoint failed: {url} id={id} from {start_date:%Y-%m-%d} to {(end_date or start_date):%Y-%m-%d}")
+        return response_json
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    first_day = start_date.date()
+    last_day = end_date.date() if end_date is not None else first_day
+    days = [first_day + datetime.timedelta(days=i) for i in range((last_day - first_day).days + 1)]
+    cache_dir = os.path.join(CACHE_DIR, url.rstrip('/').split('/')[-1], str(id))
+    cache_path = lambda day: os.path.join(cache_dir, f"{day.isoformat()}.json")
+
+    # Serve the cached days
+    samples_by_day = {}
+    for day in days:
+        if os.path.isfile(cache_path(day)):
+            with open(cache_path(day), "r") as f:
+                samples_by_day[day] = json.load(f)
+    hits = len(samples_by_day)
+
+    # Request every run of consecutive missing days at once
+    missing = [day for day in days if day not in samples_by_day]
+    runs = []
+    for day in missing:
+        if len(runs) > 0 and runs[-1][-1] + datetime.timedelta(days=1) == day:
+            runs[-1].append(day)
+        else:
+            runs.append([day])
+
+    for run in runs:
+        response_json = request_endpoint_json(url, id, run[0], end_date=run[-1] if end_date is not None else None)
+        fetched = {day: [] for day in run}
+        for sample in response_json:
+            day = datetime.date.fromisoformat(sample['TmStamp'][:10])
+            if day in fetched:
+                fetched[day].append(sample)
+
+        for day, samples in fetched.items():
+            samples_by_day[day] = samples
+            day_end = datetime.datetime.combine(day + datetime.timedelta(days=1), datetime.time(), tzinfo=datetime.timezone.utc)
+            # Days without data are requested again, the station may still upload them
+            if now < day_end + CACHE_SETTLE_TIME or len(samples) == 0:
+                continue
+            os.makedirs(cache_dir, exist_ok=True)
+            with atomic_write(cache_path(day), "w") as f:
+                json.dump(samples, f)
+
+    with cache_stats_lock:
+        cache_stats['hits'] += hits
+        cache_stats['misses'] += len(missing)
+    logging.info(f"[aws]: {url} id={id}: {hits} days from cache, {len(missing)} days requested")
+
+    response_json = [sample for day in days for sample in samples_by_day[day]]
+    if len(response_json) == 0:
+        raise Exception(f"AWS endpoint failed: {url} id={id} from {first_day} to {last_day}")
+
+    return response_json
+
+
+def log_cache_stats():
+    """ Logs the cache hits and misses since the last call, and resets them """
+    with cache_stats_lock:
+        hits, misses, n_requests = cache_stats['hits'], cache_stats['misses'], cache_stats['requests']
+        cache_stats.update(hits=0, misses=0, requests=0)
+    total = hits + misses
+    hit_rate = 100 * hits / total if total > 0 else 0
+    logging.info(f"[aws]: Station data cache: {hits} days from cache, {misses} days requested "
+                 f"({hit_rate:.0f}% hit rate), {n_requests} requests sent")
+
+
+def ctd_profile_requests(date):
+    """ Requests of the instrument data needed by get_model_ctd_profile, for fetch_concurrently
+
+    Args:
+        date (datetime): the date of the desired ctd profile
+    """
+    return {
+        'NEARSHORE': partial(get_endpoint_json, ENDPOINTS['NEARSHORE'], 9, date),
+        'TEMPERATURE_CHAIN': partial(get_endpoint_json, ENDPOINTS['TEMPERATURE_CHAIN'], 0, date),
+    }
+
+
 def get_model_ctd_profile(date):
+    """ Creates a ctd profile by combining instrument data from the Homewood nearshore
+        station and temperature chain at HWTC, both fetched at once
+
+        Args:
+            date (datetime): the date of the desired ctd profile
+    """
+    results, errors = fetch_concurrently(ctd_profile_requests(date))
+    raise_errors(errors)
+    return parse_model_ctd_profile(date, results['NEARSHORE'], results['TEMPERATURE_CHAIN'])
+
+
+def parse_model_ctd_profile(date, homewood_data, tc_data):
     """ Creates a ctd profile by combining instrument data from the Homewood nearshore
         station and temperature chain at HWTC
         Note:
@@ -64,11 +198,10 @@ def get_model_ctd_profile(date):
         
         Args:
             date (datetime): the date of the desired ctd profile
+            homewood_data (list): JSON returned by the NEARSHORE endpoint
+            tc_data (list): JSON returned by the TEMPERATURE_CHAIN endpoint
     """
     ctd_profile = []
-    
-    # Retrieve data from homewood station
-    homewood_data = get_endpoint_json(ENDPOINTS['NEARSHORE'], 9, date)
 
     # Pick closest date within given data
     parse_date = lambda date: datetime.datetime.strptime(date, "%Y-%m-%d %H:%M:%S") \
@@ -121,9 +254,6 @@ def get_model_ctd_profile(date):
         #  tc_sensor_id: an Integer in [1, 16], the ID of the temperature sensor
         return tc_depth - tc_dimensions["P1"] - tc_dimensions[f'L{tc_sensor_id}']
 
-    # Retrieve data from temperature chain
-    tc_data = get_endpoint_json(ENDPOINTS['TEMPERATURE_CHAIN'], 0, date)
-
     # Pick closest date within given data
     data_dates = [parse_date(d["TmStamp"]) for d in tc_data]
     closest_date_idx = bisect_left(data_dates, date)
@@ -141,8 +271,21 @@ def get_model_ctd_profile(date):
 
     return ctd_profile
 
+def historical_data_requests(start_date, end_date=None):
+    """ Requests of the station data needed by get_model_historical_data, for fetch_concurrently
+
+    Args:
+        start_date (datetime): start date of the query, in UTC
+        end_date (datetime, optional): end date of the query
+    """
+    return {
+        'NASA_BUOY': partial(get_endpoint_json, ENDPOINTS['NASA_BUOY'], NASA_BUOY_ID, start_date, end_date=end_date),
+        'USCG': partial(get_endpoint_json, ENDPOINTS['USCG'], USCG_ID, start_date, end_date=end_date),
+    }
+
+
 """
-1. Retrieves Lake Tahoe data from AWS
+1. Retrieves Lake Tahoe data from AWS, the NASA buoy and USCG stations at once
 2. Preprocesses the data so the model can use it
 
 Args:
@@ -158,72 +301,21 @@ Returns:
     2022-02-09 01:20:00+00:00      4.562      7.70              82042.11             0.3268    -117.6  1.975616  4.593141 
 """
 def get_model_historical_data(start_date, end_date=None):
-    parse_date = lambda date: datetime.datetime.strptime(date, "%Y-%m-%d %H:%M:%S") \
-                                               .replace(tzinfo=datetime.timezone.utc)
+    results, errors = fetch_concurrently(historical_data_requests(start_date, end_date))
+    raise_errors(errors)
+    return parse_model_historical_data(results['NASA_BUOY'], results['USCG'])
 
-    buoy_json = get_endpoint_json(ENDPOINTS['NASA_BUOY'], NASA_BUOY_ID, start_date, end_date=end_date)
-    uscg_json = get_endpoint_json(ENDPOINTS['USCG'], USCG_ID, start_date, end_date=end_date)
-
-    features = ["shortwave", "air temp", "atmospheric pressure", "relative humidity", "longwave", "wind speed", "wind direction"]
-
-    # Historical data to build and return
-    historical = defaultdict(lambda: [np.nan] * len(features))
-
-    ## Parse data samples
-    # NASA Buoy data samples
-    for data_sample in buoy_json:
-        # Parse raw data from JSON
-        time = parse_date(data_sample['TmStamp'])
-        air_temp1 = float(data_sample['AirTemp_1'])
-        air_temp2 = float(data_sample['AirTemp_2'])
-        wind_dir1 = float(data_sample['WindDir_1'])
-        wind_dir2 = float(data_sample['WindDir_2'])
-        wind_speed1 = float(data_sample['WindSpeed_1'])
-        wind_speed2 = float(data_sample['WindSpeed_2'])
-
-        # Take average of raw data that was measured with two instruments
-        wind_dir = (wind_dir1 + wind_dir2) / 2
-        wind_speed = (wind_speed1 + wind_speed2) / 2
-        air_temp = (air_temp1 + air_temp2) / 2
-        # Save data for this sample
-        historical[time][features.index("air temp")] = air_temp
-        historical[time][features.index("wind speed")] = wind_speed
-        historical[time][features.index("wind direction")] = wind_dir
 
-    # USCG data samples
-    for data_sample in uscg_json:
-        # Parse raw data
-        time = parse_date(data_sample['TmStamp'])
-        shortwave_in = float(data_sample['ShortWaveIn_wm2']) 
-        shortwave_out = float(data_sample['ShortWaveOut_wm2']) 
-        bp_mbar = float(data_sample['BP_mbar'])
-        rh_percent = float(data_sample['RH_percent'])
-        longwave_in_corr = float(data_sample['LongWaveInCorr_wm2'])
-
-        # Calculations
-        shortwave = shortwave_in - shortwave_out
-        atmospheric_pressure = bp_mbar * 100 # Convert mbar to Pa
-        relative_humidity = rh_percent / 100 # Convert to fraction
-        longwave = longwave_in_corr
-
-        # Save data for this sample
-        historical[time][features.index("shortwave")] = shortwave
-        historical[time][features.index("atmospheric pressure")] = atmospheric_pressure
-        historical[time][features.index("relative humidity")] = relative_humidity
-        historical[time][features.index("longwave")] = longwave
-
-    # Convert historical data to dataframe
-    df = pd.DataFrame(
-        [[time] + features for time, features in historical.items()],
-        columns=['time'] + features
-    )
-
-    # Trim rows that have nan
-    rows_with_nan = df.isnull().any(axis=1)
-    rows_with_nan = [idx for idx, is_nan in enumerate(rows_with_nan) if is_nan]
-    df.drop(axis=0, index=rows_with_nan, inplace=True)
+def parse_model_historical_data(buoy_json, uscg_json):
+    """ Preprocesses the JSON of the NASA buoy and USCG stations, see get_model_historical_data
 
-    df.sort_values(by=['time'], inplace=True, ignore_index=True)
+    Args:
+        buoy_json (list): JSON returned by the NASA_BUOY endpoint
+        uscg_json (list): JSON returned by the USCG endpoint
+    Returns:
+        pandas.DataFrame Object
+    """
+    df = historical_data_frame(buoy_json, uscg_json)
 
     remove_outliers(df)
 
@@ -240,6 +332,58 @@ def get_model_historical_data(start_date, end_date=None):
     return df
 
 
+HISTORICAL_FEATURES = ["shortwave", "air temp", "atmospheric pressure", "relative humidity", "longwave", "wind speed", "wind direction"]
+
+def historical_data_frame(buoy_json, uscg_json):
+    """ Loads the JSON of the NASA buoy and USCG stations into a DataFrame of the model features,
+    with one row for every time measured by both stations, sorted by time. Samples that are
+    missing a value are left out.
+
+    Args:
+        buoy_json (list): JSON returned by the NASA_BUOY endpoint
+        uscg_json (list): JSON returned by the USCG endpoint
+    Returns:
+        pandas.DataFrame with a 'time' column followed by HISTORICAL_FEATURES
+    """
+    def load(samples, columns):
+        # Only the columns that are used are converted, the timestamps with a fixed format
+        raw = pd.DataFrame.from_records(samples, columns=['TmStamp'] + columns)
+        time = pd.to_datetime(raw['TmStamp'], format="%Y-%m-%d %H:%M:%S", utc=True)
+        try:
+            values = raw[columns].astype(float)
+        except ValueError:
+            # Values that are not numbers, e.g. empty strings, are left out like missing values
+            values = raw[columns].apply(pd.to_numeric, errors='coerce')
+        values.index = pd.Index(time, name='time')
+        return values
+
+    # NASA Buoy data samples, averaging the data that was measured with two instruments
+    buoy = load(buoy_json, ['AirTemp_1', 'AirTemp_2', 'WindDir_1', 'WindDir_2', 'WindSpeed_1', 'WindSpeed_2'])
+    buoy = pd.DataFrame({
+        "air temp": (buoy['AirTemp_1'] + buoy['AirTemp_2']) / 2,
+        "wind speed": (buoy['WindSpeed_1'] + buoy['WindSpeed_2']) / 2,
+        "wind direction": (buoy['WindDir_1'] + buoy['WindDir_2']) / 2,
+    })
+
+    # USCG data samples
+    uscg = load(uscg_json, ['ShortWaveIn_wm2', 'ShortWaveOut_wm2', 'BP_mbar', 'RH_percent', 'LongWaveInCorr_wm2'])
+    uscg = pd.DataFrame({
+        "shortwave": uscg['ShortWaveIn_wm2'] - uscg['ShortWaveOut_wm2'],
+        "atmospheric pressure": uscg['BP_mbar'] * 100, # Convert mbar to Pa
+        "relative humidity": uscg['RH_percent'] / 100, # Convert to fraction
+        "longwave": uscg['LongWaveInCorr_wm2'],
+    })
+
+    # A sample repeated by a station replaces the earlier one
+    buoy = buoy[~buoy.index.duplicated(keep='last')]
+    uscg = uscg[~uscg.index.duplicated(keep='last')]
+
+    # Join the two stations on time, and trim rows that have nan
+    df = buoy.join(uscg, how='inner')[HISTORICAL_FEATURES]
+    df = df.dropna().sort_index()
+    return df.reset_index()
+
+
 ATTR_BOUNDS = {
     "relative humidity": [0, 1],
     "shortwave": [-0.001, 1300],
@@ -250,6 +394,10 @@ ATTR_BOUNDS = {
     "wind direction": [0, 360],
 }
 
+# Points of the centered windows of the median filter and of the outlier statistics
+MEDIAN_WINDOW = 5
+OUTLIER_WINDOW = 100
+
 def remove_outliers(df):
     """ Removes outliers from AWS dataframe, inplace. This is completed in 4 steps.
 
@@ -266,52 +414,81 @@ def remove_outliers(df):
 
     5. Median filtering again
 
+    All features are filtered at once by filter_outliers. Steps 3 and 4 used chained
+    inplace `where` calls, which do nothing on pandas 3 (copy-on-write), so there only steps
+    1, 2 and 5 were applied. They are now applied on every pandas version.
+
     Args:
         df (pd.DataFrame): dataframe containing historical AWS model data
     """
-    
-    median_filtering(df)
+    features = [feature for feature in df.columns if feature != 'time']
+    df[features] = filter_outliers(df[features].to_numpy(dtype=float), features)
 
-    # Clip features between lo and hi
-    for feature, (lo, hi) in ATTR_BOUNDS.items():
-        # Clip features
-        if feature in df.columns:
-            df[feature] = np.clip(df[feature], lo, hi)
 
-    # Set features > 3 std to mean
-    for feature in df.columns:
-        if feature == 'time':
-            continue
+def rolling(values, window):
+    # centered rolling window over every column of a 2-D array
+    return pd.DataFrame(values, copy=False).rolling(window=window, center=True, min_periods=1)
 
-        mean = df[feature].rolling(window=100, center=True, min_periods=1).mean()
-        std = df[feature].rolling(window=100, center=True, min_periods=1).std()
-        std[0] = 0 
-        lo = mean - 3 * std
-        hi = mean + 3 * std
 
-        # Replace deviating features with mean
-        df[feature].where(lo < df[feature], mean, inplace=True)
-        df[feature].where(df[feature] < hi, mean, inplace=True)
+def median_filter(values):
+    """ Centered rolling median of MEDIAN_WINDOW points over every column of a 2-D array,
+    the same as rolling(values, MEDIAN_WINDOW).median()
 
-    for feature, (lo, hi) in ATTR_BOUNDS.items():
-        # Shortwave is an edge case, where its okay for data to sit at the bounds
-        if feature == 'shortwave' or feature not in df.columns:
-            continue
-        mean = df[feature].rolling(window=100, center=True, min_periods=1).mean()
-        df[feature].where(df[feature] != hi, mean, inplace=True)
-        df[feature].where(df[feature] != lo, mean, inplace=True)
+    Args:
+        values (np.ndarray): samples x features array
+    """
+    if MEDIAN_WINDOW != 5 or len(values) < MEDIAN_WINDOW or np.isnan(values).any():
+        return rolling(values, MEDIAN_WINDOW).median().to_numpy()
+
+    # Median of every 5 consecutive samples with a sorting network of min / max, which picks
+    # one of the samples like the rolling median does
+    p = [values[i:len(values) - 4 + i] for i in range(5)]
+    def sort(i, j):
+        p[i], p[j] = np.minimum(p[i], p[j]), np.maximum(p[i], p[j])
+    for i, j in [(0, 1), (3, 4), (0, 3), (1, 4), (1, 2), (2, 3), (1, 2)]:
+        sort(i, j)
 
-    median_filtering(df)
+    median = np.empty_like(values)
+    median[2:-2] = p[2]
+    # The first and last two samples have fewer neighbors
+    median[:2] = rolling(values[:4], MEDIAN_WINDOW).median().to_numpy()[:2]
+    median[-2:] = rolling(values[-4:], MEDIAN_WINDOW).median().to_numpy()[-2:]
+    return median
 
 
-def median_filtering(df):
-    """Replaces points with the median of neighboring points, inplace
+def filter_outliers(values, features):
+    """ Runs the steps of remove_outliers over all features at once, as a 2-D array
 
     Args:
-        df (pd.DataFrame): DataFrame to filter
+        values (np.ndarray): samples x features array, sorted by time
+        features (list): name of the feature in every column of values
+    Returns:
+        np.ndarray: filtered copy of values
     """
-    for feature in df.columns:
-        if feature == 'time':
-            continue
-        median = df[feature].rolling(window=5, min_periods=1, center=True).median()
-        df[feature] = median
+    bounds = [ATTR_BOUNDS.get(feature, [-np.inf, np.inf]) for feature in features]
+    lo, hi = np.array(bounds, dtype=float).T
+
+    values = median_filter(values)
+
+    # Clip features between lo and hi, features without bounds are unchanged
+    values = np.clip(values, lo, hi)
+
+    # Set features > 3 std to mean, the first sample always gets the mean
+    window = rolling(values, OUTLIER_WINDOW)
+    mean = window.mean().to_numpy()
+    std = window.std().to_numpy(copy=True)
+    std[0] = 0
+    deviating = ~((mean - 3 * std < values) & (values < mean + 3 * std))
+    values = np.where(deviating, mean, values)
+
+    # Replace features still sitting at the bounds with the mean of the data after the step above
+    # Shortwave is an edge case, where its okay for data to sit at the bounds
+    checked = np.array([feature in ATTR_BOUNDS and feature != 'shortwave' for feature in features])
+    at_bounds = ((values == lo) | (values == hi)) & checked
+    columns = np.flatnonzero(at_bounds.any(axis=0))
+    if len(columns) > 0:
+        mean = rolling(values[:, columns], OUTLIER_WINDOW).mean().to_numpy()
+        values[:, columns] = np.where(at_bounds[:, columns], mean, values[:, columns])
+
+    return median_filter(values)
+
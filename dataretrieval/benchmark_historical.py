@@ -0,0 +1,111 @@
+"""
+Use this script to measure how long get_model_historical_data takes to parse the NASA buoy
+and USCG payloads, on synthetic payloads of several lengths of 10 minute samples.
+- Compares aws.historical_data_frame with the sample by sample parsing it replaced, and checks
+that both return the same DataFrame.
+
+Run from the root of the repository:
+
+`python -m dataretrieval.benchmark_historical --days 10 90 365`
+"""
+
+from collections import defaultdict
+from dataretrieval.aws import historical_data_frame
+from dataretrieval.local_api import synthetic_sample
+import numpy as np
+import pandas as pd
+import argparse
+import datetime
+import time
+
+
+def synthetic_payloads(days):
+    """ Returns NASA buoy and USCG payloads with 10 minute samples over the given number of days,
+    with a few missing values and repeated samples like the real stations
+    """
+    start = datetime.datetime(2022, 1, 1, tzinfo=datetime.timezone.utc)
+    times = [start + datetime.timedelta(minutes=10 * i) for i in range(days * 24 * 6)]
+    buoy_json = [synthetic_sample('nasa-tb', 4, t) for t in times]
+    uscg_json = [synthetic_sample('met-uscg2020', 1, t) for t in times]
+
+    rng = np.random.default_rng(0)
+    for i in rng.choice(len(times), size=len(times) // 200, replace=False):
+        buoy_json[i]['WindSpeed_2'] = "NAN"
+    for i in rng.choice(len(times), size=len(times) // 300, replace=False):
+        uscg_json[i]['BP_mbar'] = "NAN"
+    uscg_json += [dict(sample, RH_percent="50.0") for sample in uscg_json[::500]]
+    return buoy_json, uscg_json
+
+
+def legacy_historical_data_frame(buoy_json, uscg_json):
+    """ Parsing of get_model_historical_data before historical_data_frame, sample by sample """
+    parse_date = lambda date: datetime.datetime.strptime(date, "%Y-%m-%d %H:%M:%S") \
+                                               .replace(tzinfo=datetime.timezone.utc)
+
+    features = ["shortwave", "air temp", "atmospheric pressure", "relative humidity", "longwave", "wind speed", "wind direction"]
+    historical = defaultdict(lambda: [np.nan] * len(features))
+
+    for data_sample in buoy_json:
+        time = parse_date(data_sample['TmStamp'])
+        air_temp1 = float(data_sample['AirTemp_1'])
+        air_temp2 = float(data_sample['AirTemp_2'])
+        wind_dir1 = float(data_sample['WindDir_1'])
+        wind_dir2 = float(data_sample['WindDir_2'])
+        wind_speed1 = float(data_sample['WindSpeed_1'])
+        wind_speed2 = float(data_sample['WindSpeed_2'])
+
+        historical[time][features.index("air temp")] = (air_temp1 + air_temp2) / 2
+        historical[time][features.index("wind speed")] = (wind_speed1 + wind_speed2) / 2
+        historical[time][features.index("wind direction")] = (wind_dir1 + wind_dir2) / 2
+
+    for data_sample in uscg_json:
+        time = parse_date(data_sample['TmStamp'])
+        shortwave_in = float(data_sample['ShortWaveIn_wm2'])
+        shortwave_out = float(data_sample['ShortWaveOut_wm2'])
+        bp_mbar = float(data_sample['BP_mbar'])
+        rh_percent = float(data_sample['RH_percent'])
+        longwave_in_corr = float(data_sample['LongWaveInCorr_wm2'])
+
+        historical[time][features.index("shortwave")] = shortwave_in - shortwave_out
+        historical[time][features.index("atmospheric pressure")] = bp_mbar * 100
+        historical[time][features.index("relative humidity")] = rh_percent / 100
+        historical[time][features.index("longwave")] = longwave_in_corr
+
+    df = pd.DataFrame(
+        [[time] + features for time, features in historical.items()],
+        columns=['time'] + features
+    )
+
+    rows_with_nan = df.isnull().any(axis=1)
+    rows_with_nan = [idx for idx, is_nan in enumerate(rows_with_nan) if is_nan]
+    df.drop(axis=0, index=rows_with_nan, inplace=True)
+
+    df.sort_values(by=['time'], inplace=True, ignore_index=True)
+    return df
+
+
+def benchmark(parse, buoy_json, uscg_json, repeat=3):
+    # best of a few runs
+    elapsed = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        df = parse(buoy_json, uscg_json)
+        elapsed.append(time.perf_counter() - start)
+    return df, min(elapsed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures the parsing of the AWS station payloads")
+    parser.add_argument("--days", type=int, nargs="+", default=[10, 90, 365], help="lengths of the payloads")
+    args = parser.parse_args()
+
+    print(f"{'days':>6}{'samples':>10}{'rows':>10}{'legacy s':>12}{'vectorized s':>14}{'speedup':>10}")
+    for days in args.days:
+        buoy_json, uscg_json = synthetic_payloads(days)
+        legacy, legacy_time = benchmark(legacy_historical_data_frame, buoy_json, uscg_json)
+        vectorized, vectorized_time = benchmark(historical_data_frame, buoy_json, uscg_json)
+
+        assert vectorized.equals(legacy), f"historical_data_frame differs from the legacy parsing on {days} days"
+        assert list(vectorized.columns) == list(legacy.columns) and (vectorized.dtypes == legacy.dtypes).all()
+        print(f"{days:>6}{len(buoy_json) + len(uscg_json):>10}{len(vectorized):>10}{legacy_time:>12.3f}"
+              f"{vectorized_time:>14.3f}{legacy_time / vectorized_time:>9.1f}x")
@@ -0,0 +1,104 @@
+"""
+Use this script to measure aws.remove_outliers on 10 days and on 1 year of 10 minute data.
+- Compares the 2-D filter_outliers engine with the column by column filtering it replaced,
+and checks that both return the same data.
+
+The column by column filtering used chained `df[feature].where(..., inplace=True)` calls, which
+only update df on pandas versions without copy-on-write. It is reproduced here with explicit
+assignments, which is what it did on those versions.
+
+Run from the root of the repository:
+
+`python -m dataretrieval.benchmark_outliers --days 10 365`
+"""
+
+from dataretrieval.aws import ATTR_BOUNDS, historical_data_frame, remove_outliers
+from dataretrieval.benchmark_historical import synthetic_payloads
+import numpy as np
+import argparse
+import time
+
+
+def synthetic_features(days):
+    """ Returns a historical DataFrame with spikes, values out of bounds and values sitting
+    at the bounds, like the real stations
+    """
+    df = historical_data_frame(*synthetic_payloads(days))
+    rng = np.random.default_rng(1)
+    n = len(df)
+    for feature in df.columns[1:]:
+        rows = rng.choice(n, size=n // 100, replace=False)
+        df.loc[rows, feature] += rng.normal(0, 20, size=len(rows)) * df[feature].std()
+        lo, hi = ATTR_BOUNDS[feature]
+        df.loc[rng.choice(n, size=n // 200, replace=False), feature] = lo
+        df.loc[rng.choice(n, size=n // 500, replace=False), feature] = hi + 1
+    # A calm week, the wind speed sits at its lower bound
+    df.loc[n // 3:n // 3 + 6 * 24 * 7, "wind speed"] = 0.0
+    return df
+
+
+def legacy_remove_outliers(df):
+    """ remove_outliers before filter_outliers, one column and one rolling statistic at a time """
+    legacy_median_filtering(df)
+
+    for feature, (lo, hi) in ATTR_BOUNDS.items():
+        if feature in df.columns:
+            df[feature] = np.clip(df[feature], lo, hi)
+
+    for feature in df.columns:
+        if feature == 'time':
+            continue
+
+        mean = df[feature].rolling(window=100, center=True, min_periods=1).mean()
+        std = df[feature].rolling(window=100, center=True, min_periods=1).std()
+        std[0] = 0
+        lo = mean - 3 * std
+        hi = mean + 3 * std
+
+        df[feature] = df[feature].where(lo < df[feature], mean)
+        df[feature] = df[feature].where(df[feature] < hi, mean)
+
+    for feature, (lo, hi) in ATTR_BOUNDS.items():
+        if feature == 'shortwave' or feature not in df.columns:
+            continue
+        mean = df[feature].rolling(window=100, center=True, min_periods=1).mean()
+        df[feature] = df[feature].where(df[feature] != hi, mean)
+        df[feature] = df[feature].where(df[feature] != lo, mean)
+
+    legacy_median_filtering(df)
+
+
+def legacy_median_filtering(df):
+    for feature in df.columns:
+        if feature == 'time':
+            continue
+        median = df[feature].rolling(window=5, min_periods=1, center=True).median()
+        df[feature] = median
+
+
+def benchmark(filter, df, repeat=5):
+    # best of a few runs, each on its own copy since the filters work inplace
+    elapsed = []
+    for _ in range(repeat):
+        filtered = df.copy()
+        start = time.perf_counter()
+        filter(filtered)
+        elapsed.append(time.perf_counter() - start)
+    return filtered, min(elapsed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures remove_outliers")
+    parser.add_argument("--days", type=int, nargs="+", default=[10, 365], help="lengths of the data")
+    args = parser.parse_args()
+
+    print(f"{'days':>6}{'rows':>10}{'legacy ms':>12}{'2-D ms':>10}{'speedup':>10}")
+    for days in args.days:
+        df = synthetic_features(days)
+        legacy, legacy_time = benchmark(legacy_remove_outliers, df)
+        engine, engine_time = benchmark(remove_outliers, df)
+
+        assert not legacy.equals(df), "legacy filtering did not change the data"
+        assert engine.equals(legacy), f"remove_outliers differs from the legacy filtering on {days} days"
+        print(f"{days:>6}{len(df):>10}{legacy_time * 1000:>12.1f}{engine_time * 1000:>10.1f}"
+              f"{legacy_time / engine_time:>9.1f}x")
@@ -0,0 +1,61 @@
+""" The purpose of this file is to issue the requests of the data retrieval service
+concurrently. Every request spends most of its time waiting on the network, so running
+them on a thread pool makes the wall time of a fetch the time of the slowest request
+instead of the sum of all of them.
+
+Example Usage:
+>>> from functools import partial
+>>> results, errors = fetch_concurrently({
+...     'NASA_BUOY': partial(get_endpoint_json, ENDPOINTS['NASA_BUOY'], NASA_BUOY_ID, start_date),
+...     'NWS': get_nws_forecast_json,
+... })
+>>> buoy_json = results['NASA_BUOY']
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import time
+
+# Requests in flight at once, one per upstream endpoint
+FETCH_WORKERS = 5
+
+
+def fetch_concurrently(requests, max_workers=FETCH_WORKERS):
+    """ Runs every request at once and waits for all of them to finish
+
+    Args:
+        requests (dict): request name -> function without arguments that performs the request
+        max_workers (int, optional): number of requests in flight at once
+    Returns:
+        tuple(dict, dict): request name -> result of the requests that succeeded, and
+        request name -> exception of the requests that failed
+    """
+    def timed(name, request):
+        start = time.perf_counter()
+        result = request()
+        logging.info(f"[fetch]: {name} took {time.perf_counter() - start:.2f} s")
+        return result
+
+    start = time.perf_counter()
+    results, errors = {}, {}
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(requests)))) as executor:
+        futures = {name: executor.submit(timed, name, request) for name, request in requests.items()}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                logging.warning(f"[fetch]: {name} failed: {e}")
+                errors[name] = e
+
+    logging.info(f"[fetch]: Fetched {len(results)} of {len(requests)} requests in {time.perf_counter() - start:.2f} s")
+    return results, errors
+
+
+def raise_errors(errors):
+    """ Raises the first error returned by fetch_concurrently, if any
+
+    Args:
+        errors (dict): request name -> exception
+    """
+    for name, error in errors.items():
+        raise error
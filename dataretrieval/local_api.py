@@ -0,0 +1,293 @@
+""" Local stand-in for the TERC AWS API and the NWS gridpoint forecast, to test the data
+retrieval service without network.
+
+The stand-in serves the endpoints in aws.ENDPOINTS with synthetic samples. Every sample is
+computed from its timestamp, so a day is the same whenever it is requested, and samples stop
+at the current time, so today is always a partial day like on the real API. The gridpoint
+forecast changes every hour, and is served with an ETag and Last-Modified like the NWS API.
+Responses are gzipped when asked for and connections are kept alive.
+
+Run from the root of the repository to check the station data cache of aws.get_endpoint_json,
+the pooled connections and the revalidation of the NWS forecast against the stand-in:
+
+`python -m dataretrieval.local_api`
+
+or to only serve the endpoints, e.g. to point aws.ENDPOINTS and nws.NWS_API_URL at them from
+another process:
+
+`python -m dataretrieval.local_api --serve --port 8000`
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from email.utils import format_datetime, parsedate_to_datetime
+from urllib.parse import urlparse, parse_qs
+from collections import Counter
+import dataretrieval.aws as aws
+import dataretrieval.nws as nws
+import argparse
+import datetime
+import tempfile
+import threading
+import gzip
+import json
+import math
+import time
+import os
+
+# Minutes between two samples of every endpoint
+SAMPLE_INTERVALS = {
+    'met-uscg2020': 10,
+    'nasa-tb': 10,
+    'ns-station-range': 20,
+    'tc-homewood': 20,
+}
+
+
+def synthetic_sample(endpoint, id, time):
+    """ Returns the sample of an endpoint at the given time, formatted like the real API
+
+    Args:
+        endpoint (str): last component of the endpoint url, e.g. 'nasa-tb'
+        id (str): station id
+        time (datetime.datetime): time of the sample, in UTC
+    """
+    hours = time.timestamp() / 3600
+    day = math.sin(2 * math.pi * hours / 24)
+    noise = math.sin(hours * 12.9898) * 0.5
+    sample = {
+        "ID": str(id),
+        "TmStamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    if endpoint == 'nasa-tb':
+        sample.update({
+            "AirTemp_1": f"{5 + 6 * day + noise:.2f}",
+            "AirTemp_2": f"{5 + 6 * day - noise:.2f}",
+            "WindDir_1": f"{(180 + 120 * day) % 360:.1f}",
+            "WindDir_2": f"{(185 + 120 * day) % 360:.1f}",
+            "WindSpeed_1": f"{4 + 2 * day + noise:.1f}",
+            "WindSpeed_2": f"{4 + 2 * day:.1f}",
+        })
+    elif endpoint == 'met-uscg2020':
+        sample.update({
+            "ShortWaveIn_wm2": f"{max(0, 900 * day):.3f}",
+            "ShortWaveOut_wm2": f"{max(0, 90 * day):.3f}",
+            "BP_mbar": f"{816 + 3 * day + noise:.2f}",
+            "RH_percent": f"{45 - 15 * day + noise:.2f}",
+            "LongWaveInCorr_wm2": f"{260 + 30 * day + noise:.1f}",
+        })
+    elif endpoint == 'ns-station-range':
+        sample["LS_Temp_Avg"] = f"{8 + day + noise:.4f}"
+    elif endpoint == 'tc-homewood':
+        sample["Depth_m4C_Avg"] = f"{108 + noise:.3f}"
+        for sensor_id in range(1, 17):
+            sample[f"LS_T{sensor_id}_Avg"] = f"{5 + sensor_id / 4 + day * (16 - sensor_id) / 16:.4f}"
+    return sample
+
+
+def synthetic_forecast(updated):
+    """ Returns the gridpoint forecast issued at the given hour, formatted like the NWS API
+
+    Args:
+        updated (datetime.datetime): time the forecast was issued, in UTC
+    """
+    hours = updated.timestamp() / 3600
+    values = lambda f: [{
+        "validTime": f"{(updated + datetime.timedelta(hours=h)).isoformat()}/PT1H",
+        "value": round(f(hours + h), 2),
+    } for h in range(7 * 24)]
+    day = lambda h: math.sin(2 * math.pi * h / 24)
+    return {
+        "type": "Feature",
+        "properties": {
+            "updateTime": updated.isoformat(),
+            "temperature": {"uom": "wmoUnit:degC", "values": values(lambda h: 5 + 6 * day(h))},
+            "relativeHumidity": {"uom": "wmoUnit:percent", "values": values(lambda h: 45 - 15 * day(h))},
+            "skyCover": {"uom": "wmoUnit:percent", "values": values(lambda h: 50 + 40 * day(h / 5))},
+            "windDirection": {"uom": "wmoUnit:degree_(angle)", "values": values(lambda h: (180 + 120 * day(h)) % 360)},
+            "windSpeed": {"uom": "wmoUnit:km_h-1", "values": values(lambda h: 12 + 8 * day(h))},
+        },
+    }
+
+
+class LocalAPIHandler(BaseHTTPRequestHandler):
+    """ Serves GET <path>/<endpoint>?id=<id>&rptdate=<YYYYMMDD>[&rptend=<YYYYMMDD>] and
+    GET /gridpoints/<office>/<gx>,<gy>
+    """
+    # Keep-alive, so pooled clients can reuse their connections
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def send_json(self, data, headers={}):
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body)
+            self.send_header("Content-Encoding", "gzip")
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.bytes_sent += len(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path.startswith("/gridpoints/"):
+            self.get_forecast()
+            return
+
+        endpoint = url.path.rstrip('/').split('/')[-1]
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if endpoint not in SAMPLE_INTERVALS or 'rptdate' not in params:
+            self.send_error(404)
+            return
+
+        self.server.requests[endpoint] += 1
+        time.sleep(self.server.latency)
+
+        # Every sample from the start of rptdate to the end of rptend, until now
+        parse_date = lambda date: datetime.datetime.strptime(date, "%Y%m%d").replace(tzinfo=datetime.timezone.utc)
+        start = parse_date(params['rptdate'])
+        end = parse_date(params.get('rptend', params['rptdate'])) + datetime.timedelta(days=1)
+        end = min(end, datetime.datetime.now(datetime.timezone.utc))
+        interval = datetime.timedelta(minutes=SAMPLE_INTERVALS[endpoint])
+        samples = []
+        while start < end:
+            samples.append(synthetic_sample(endpoint, params.get('id', 0), start))
+            start += interval
+
+        self.send_json(samples)
+
+    def get_forecast(self):
+        self.server.requests['gridpoints'] += 1
+        time.sleep(self.server.latency)
+
+        # A new forecast is issued every hour
+        updated = datetime.datetime.now(datetime.timezone.utc).replace(minute=0, second=0, microsecond=0)
+        etag = f'"{updated:%Y%m%d%H}"'
+        last_modified = format_datetime(updated, usegmt=True)
+
+        if_none_match = self.headers.get("If-None-Match")
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_none_match is not None:
+            unchanged = if_none_match == etag
+        else:
+            unchanged = if_modified_since is not None and parsedate_to_datetime(if_modified_since) >= updated
+        if unchanged:
+            self.server.requests['not modified'] += 1
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", last_modified)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        self.send_json(synthetic_forecast(updated), headers={"ETag": etag, "Last-Modified": last_modified})
+
+    def log_message(self, format, *args):
+        # Keep the output of the check readable
+        return
+
+
+def serve(port=0, latency=0.0):
+    """ Starts the stand-in on a background thread
+
+    Args:
+        port (int, optional): port to listen on, any free port if 0
+        latency (float, optional): seconds added to every request
+    Returns:
+        tuple(ThreadingHTTPServer, str): the server and its url. The server counts the requests
+        per endpoint in server.requests, the connections opened in server.connections and the
+        response bytes in server.bytes_sent
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), LocalAPIHandler)
+    server.requests = Counter()
+    server.connections = 0
+    server.bytes_sent = 0
+    server.latency = latency
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/"
+
+
+def use_local_api(base_url):
+    """ Points aws.ENDPOINTS and nws.NWS_API_URL at the stand-in
+
+    Args:
+        base_url (str): url returned by serve
+    """
+    for name, url in aws.ENDPOINTS.items():
+        aws.ENDPOINTS[name] = base_url + "v1/report/" + url.rstrip('/').split('/')[-1]
+    nws.NWS_API_URL = base_url
+
+
+def check_cache(server):
+    """ Fetches 10 days of historical data twice from the stand-in, and checks that the
+    second run only requests today and returns the same data as without the cache
+    """
+    today = datetime.datetime.now(datetime.timezone.utc)
+    start_date = today - datetime.timedelta(days=10)
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        aws.CACHE_DIR = cache_dir
+        results = []
+        for run in ("without cache", "first run", "second run"):
+            aws.USE_CACHE = run != "without cache"
+            server.requests.clear()
+            start = time.perf_counter()
+            results.append(aws.get_model_historical_data(start_date, end_date=today))
+            elapsed = time.perf_counter() - start
+            print(f"{run:<14}{len(results[-1]):>6} rows {sum(server.requests.values()):>3} requests {elapsed:>7.2f} s  "
+                  f"{dict(aws.cache_stats)}")
+            aws.log_cache_stats()
+
+    for result in results[1:]:
+        assert result.equals(results[0]), "cached data differs from the endpoints"
+    print("cached data matches the endpoints")
+
+
+def check_forecast(server):
+    """ Fetches the forecast twice from the stand-in, and checks that the second request is
+    answered with a 304 and returns the same forecast
+    """
+    with tempfile.TemporaryDirectory() as cache_dir:
+        nws.NWS_CACHE_PATH = os.path.join(cache_dir, "gridpoint.json")
+        results = []
+        for run in ("first request", "revalidation"):
+            server.requests.clear()
+            bytes_sent = server.bytes_sent
+            start = time.perf_counter()
+            results.append(nws.get_model_forecast_data())
+            elapsed = time.perf_counter() - start
+            print(f"{run:<14}{len(results[-1]):>6} rows {server.bytes_sent - bytes_sent:>8} bytes {elapsed:>7.3f} s  "
+                  f"{dict(server.requests)}")
+
+    assert server.requests['not modified'] == 1, "unchanged forecast was downloaded again"
+    assert results[1].equals(results[0]), "revalidated forecast differs"
+    print("revalidated forecast matches")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the TERC AWS API")
+    parser.add_argument("--serve", action="store_true", help="only serve the endpoints until interrupted")
+    parser.add_argument("--port", type=int, default=8000, help="port to serve on with --serve")
+    parser.add_argument("--latency", type=float, default=0.1, help="seconds added to every request")
+    args = parser.parse_args()
+
+    if args.serve:
+        server, base_url = serve(args.port, args.latency)
+        print(f"Serving {', '.join(SAMPLE_INTERVALS)} at {base_url}")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            server.shutdown()
+    else:
+        server, base_url = serve(latency=args.latency)
+        use_local_api(base_url)
+        check_cache(server)
+        check_forecast(server)
+        print(f"{server.connections} connections opened")
+        server.shutdown()
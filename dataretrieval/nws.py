@@ -18,10 +18,18 @@ from collections import defaultdict
 from datetime import timedelta
 from math import nan
 from dateutil import parser
-import requests
+from dataretrieval.sessions import conditional_get
 import pandas as pd
 import numpy as np
 
+NWS_API_URL = "https://api.weather.gov/"
+
+# Last gridpoint forecast, revalidated with its ETag / Last-Modified on the next request
+NWS_CACHE_PATH = "./cache/nws/gridpoint.json"
+
+# Forecast parsed last by get_model_forecast_data, reused while the NWS forecast is unchanged
+last_forecast = {'data': None, 'df': None}
+
 
 def parse_interval(interval):
     """
@@ -82,8 +90,11 @@ def get_nws_json():
 
     gx, gy are constants from the following api call for lake tahoe (39.0961,-120.0397)
     https://api.weather.gov/points/{latitude},{longitude} 
+
+    The forecast only updates every hour or so, so the last one is kept in NWS_CACHE_PATH
+    and an unchanged forecast is answered with a 304 instead of downloaded again
     """
-    base_url = "https://api.weather.gov/"
+    base_url = NWS_API_URL
     office = "REV" 
     gx, gy = 33, 87 # Lake Tahoe
 
@@ -93,28 +104,18 @@ def get_nws_json():
         "Accept": "application/geo+json"
     }
 
-    response = requests.get(url, headers=headers).json()
+    response, _ = conditional_get(url, NWS_CACHE_PATH, headers=headers,
+                                  is_valid=lambda data: 'properties' in data)
     return response
 
 
-def get_model_forecast_data():
+def get_nws_forecast_json():
     """
-    Retrieves data from the nws api and filters it to contain only data
-    required by the model 
+    Retrieves the gridpoint forecast from the nws api, trying again when the api fails
 
     Returns:
-        pandas.DataFrame - tabulated model forecast inputs, example below:
-                               time  shortwave   air temp  atmospheric pressure   relative humidity    longwave     wind u     wind v  
-        0 2022-02-03 12:00:00+00:00        NaN -15.555556                   NaN                  49  158.532795  12.901979  15.765701     
-        1 2022-02-03 13:00:00+00:00        NaN -16.111111                   NaN                  50  154.217981  12.901979  15.765701   
-        2 2022-02-03 14:00:00+00:00        NaN -16.666667                   NaN                  53  152.228903  -1.839935 -16.566136   
-        3 2022-02-03 15:00:00+00:00        NaN -15.555556                   NaN                  48  154.436574  11.729072  14.332455   
-        4 2022-02-03 16:00:00+00:00        NaN -13.888889                   NaN                  44  166.650116  16.420700  20.065438                                                                            
-
-    Units:         pandas Timestamp        wm2    Celcius                    Pa            fraction         wm2         ms         ms
+        dict - forecast GeoJSON, with the forecasted values in 'properties'
     """
-    features = ["time", "shortwave", "air temp", "atmospheric pressure", "relative humidity", "longwave", "wind u", "wind v"]
-
     # Attempt to get data from NWS API multiple times
     # Sometimes API fails and gives us 'Unexpected Problem' as a response
     for req_attempt in range(5):
@@ -123,13 +124,43 @@ def get_model_forecast_data():
             # API returned data successfully
             break
         else:
-            print("get_model_forecast_data(): Failed to retrieve forecast data, trying again")
+            print("get_nws_forecast_json(): Failed to retrieve forecast data, trying again")
 
     if 'properties' not in data:
         # API failed to return data multiple times
         # API is most likely down, so throw an Exception
         raise Exception("National Weather Service API (NWS) is likely down. Could not retrieve forecasted weather data")
 
+    return data
+
+
+def get_model_forecast_data(data=None):
+    """
+    Retrieves data from the nws api and filters it to contain only data
+    required by the model 
+
+    Arguments:
+        data (dict, optional): forecast returned by get_nws_forecast_json, retrieved if None
+
+    Returns:
+        pandas.DataFrame - tabulated model forecast inputs, example below:
+                               time  shortwave   air temp  atmospheric pressure   relative humidity    longwave     wind u     wind v  
+        0 2022-02-03 12:00:00+00:00        NaN -15.555556                   NaN                  49  158.532795  12.901979  15.765701     
+        1 2022-02-03 13:00:00+00:00        NaN -16.111111                   NaN                  50  154.217981  12.901979  15.765701   
+        2 2022-02-03 14:00:00+00:00        NaN -16.666667                   NaN                  53  152.228903  -1.839935 -16.566136   
+        3 2022-02-03 15:00:00+00:00        NaN -15.555556                   NaN                  48  154.436574  11.729072  14.332455   
+        4 2022-02-03 16:00:00+00:00        NaN -13.888889                   NaN                  44  166.650116  16.420700  20.065438                                                                            
+
+    Units:         pandas Timestamp        wm2    Celcius                    Pa            fraction         wm2         ms         ms
+    """
+    features = ["time", "shortwave", "air temp", "atmospheric pressure", "relative humidity", "longwave", "wind u", "wind v"]
+
+    if data is None:
+        data = get_nws_forecast_json()
+    if data is last_forecast['data']:
+        # Unchanged since the last call
+        return last_forecast['df'].copy()
+
     nws_features = ['windDirection', 'windSpeed', 'temperature', 'skyCover', 'relativeHumidity']
     model_data = defaultdict(lambda: [nan] * len(nws_features))
     
@@ -185,4 +216,6 @@ def get_model_forecast_data():
 
     df.sort_values(by=['time'])
     df.reset_index(inplace=True, drop=True)
+
+    last_forecast.update(data=data, df=df.copy())
     return df
\ No newline at end of file
@@ -5,6 +5,8 @@ List of Tasks:
 
 1. retrieve
     - This retrieves data from AWS and NWS and stores it in a database
+    - All endpoints are requested at once, including the instruments of the ctd profile
+    when a profile date is given
     - TODO Notes:
     - Since MySQL is not set up yet, this will store the retrieved data in a
     csv file. If the csv file already exists, it will append the data to it.
@@ -17,8 +19,9 @@ Example Usage:
 >>> drs.retrieve()
 """
 
-from dataretrieval.aws import get_model_historical_data
-from dataretrieval.nws import get_model_forecast_data
+from dataretrieval.aws import historical_data_requests, parse_model_historical_data, ctd_profile_requests, parse_model_ctd_profile, log_cache_stats
+from dataretrieval.nws import get_nws_forecast_json, get_model_forecast_data
+from dataretrieval.fetch import fetch_concurrently, raise_errors
 import datetime
 import pandas as pd
 import os
@@ -45,6 +48,7 @@ class DataRetrievalService:
             self.db['time'] = pd.to_datetime(self.db['time'])
         else:
             self.db = None
+        self.ctd_profile = None
 
 
     def save(self):
@@ -52,14 +56,36 @@ class DataRetrievalService:
             self.db.to_csv(self.CSV_FILE, index=False)
 
 
-    def retrieve(self):
+    def retrieve(self, ctd_date=None):
         """ Retrieves data from [today - 10 days, today + 7 days], and stores it in the database,
         replacing what values already exist if any.
+
+        Args:
+            ctd_date (datetime.datetime, optional): if given, the ctd profile on this date is fetched
+            along with the other data and stored in self.ctd_profile. Left to None if it failed
         """
         today = datetime.datetime.now(datetime.timezone.utc)
         last_week = today - datetime.timedelta(days=10)
-        aws_data = get_model_historical_data(start_date=last_week, end_date=today)
-        nws_data = get_model_forecast_data()
+
+        # Every endpoint is requested at once
+        requests = historical_data_requests(start_date=last_week, end_date=today)
+        requests['NWS'] = get_nws_forecast_json
+        if ctd_date is not None:
+            requests.update(ctd_profile_requests(ctd_date))
+        results, errors = fetch_concurrently(requests)
+        log_cache_stats()
+
+        # The ctd profile has a fallback, so only the surface data has to succeed
+        self.ctd_profile = None
+        if ctd_date is not None and not any(name in errors for name in ctd_profile_requests(ctd_date)):
+            try:
+                self.ctd_profile = parse_model_ctd_profile(ctd_date, results['NEARSHORE'], results['TEMPERATURE_CHAIN'])
+            except Exception as e:
+                logging.warning(f"[DataRetrievalService]: Failed to parse ctd profile: {e}")
+        raise_errors({name: error for name, error in errors.items() if name in ('NASA_BUOY', 'USCG', 'NWS')})
+
+        aws_data = parse_model_historical_data(results['NASA_BUOY'], results['USCG'])
+        nws_data = get_model_forecast_data(results['NWS'])
     
         # Combine the two
         most_recent_aws_date = aws_data['time'][len(aws_data) - 1] if len(aws_data) > 0 else today
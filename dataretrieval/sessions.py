@@ -0,0 +1,109 @@
+""" The purpose of this file is to share HTTP connections between the requests of the data
+retrieval service.
+
+Every request made through get_session reuses the keep-alive connections of a single pooled
+requests.Session, asks for gzip responses, and is retried with exponential backoff when the
+connection fails or the server answers with a transient error. conditional_get additionally
+revalidates a cached response with ETag / If-Modified-Since, so an unchanged resource costs
+a 304 instead of a full download.
+
+Example Usage:
+>>> from dataretrieval.sessions import get_session
+>>> response = get_session().get(url, params=params, timeout=REQUEST_TIMEOUT)
+"""
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from atomic_write import atomic_write
+import threading
+import logging
+import requests
+import json
+import os
+
+# Connections kept alive per host, the service requests at most 5 endpoints at once
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 8
+# Retries of a failed request, waiting RETRY_BACKOFF * 2^(retry - 1) seconds between them
+RETRY_TOTAL = 3
+RETRY_BACKOFF = 0.5
+RETRY_STATUS = (429, 500, 502, 503, 504)
+# Seconds to wait for the server to connect and to answer
+REQUEST_TIMEOUT = (10, 60)
+
+session = None
+session_lock = threading.Lock()
+
+# Responses of conditional_get already loaded by this process, by cache path
+conditional_responses = {}
+
+
+def get_session():
+    """ Returns the requests.Session shared by every request of the process """
+    global session
+    with session_lock:
+        if session is None:
+            retry = Retry(
+                total=RETRY_TOTAL,
+                backoff_factor=RETRY_BACKOFF,
+                status_forcelist=RETRY_STATUS,
+                allowed_methods=["GET"],
+                respect_retry_after_header=True,
+                raise_on_status=False,  # the last response is returned, like without retries
+            )
+            adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, max_retries=retry)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers["Accept-Encoding"] = "gzip, deflate"
+        return session
+
+
+def conditional_get(url, cache_path, headers=None, is_valid=None):
+    """ Gets a JSON resource, revalidating the copy cached in cache_path if there is one
+
+    The copy is stored with the ETag and Last-Modified of its response. They are sent back as
+    If-None-Match and If-Modified-Since, and a 304 answer returns the cached copy. Within a
+    process the same object is returned as long as the resource is unchanged.
+
+    Args:
+        url (str): url of the resource
+        cache_path (str): json file caching the last valid response
+        headers (dict, optional): headers of the request
+        is_valid (function, optional): returns False for JSON that must not be cached, e.g. an
+            error returned with status 200
+    Returns:
+        tuple(object, bool): the JSON, and whether it changed since the cached copy
+    """
+    cached = conditional_responses.get(cache_path)
+    if cached is None and os.path.isfile(cache_path):
+        with open(cache_path, "r") as f:
+            cached = json.load(f)
+
+    headers = dict(headers or {})
+    if cached is not None:
+        if cached.get("etag") is not None:
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified") is not None:
+            headers["If-Modified-Since"] = cached["last_modified"]
+
+    response = get_session().get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+    if response.status_code == 304 and cached is not None:
+        logging.info(f"[sessions]: {url} is unchanged, using the cached copy")
+        conditional_responses[cache_path] = cached
+        return cached["body"], False
+
+    body = response.json()
+    if not response.ok or (is_valid is not None and not is_valid(body)):
+        return body, True
+
+    cached = {
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "body": body,
+    }
+    conditional_responses[cache_path] = cached
+    os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+    with atomic_write(cache_path, "w") as f:
+        json.dump(cached, f)
+    return body, True
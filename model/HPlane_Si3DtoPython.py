@@ -6,10 +6,12 @@
 # - This script also creates DateTime variable for plotting purposes.
 
 # USER GUIDE:
-# output = HPlane_Si3dToPython(Plane,dx,SimPath):
+# output = HPlane_Si3dToPython(Plane,dx,fields,dtype):
 # variable = Format. Description.
 # Plane = Integer. Number of the plane/s obtained from the Si3D numerical simulations. It is obtained from si3d input file 'si3d_inp.txt' as plane x
 # dx = Float. Delta x value from numerical simulation. Grid resolution 'm'. 
+# fields = Tuple. Fields to grid, any of 'u', 'v', 'w', 'T', 'Az', 'l'. Defaults to u, v, w and T.
+# dtype = NumPy dtype of the output. Defaults to float32, the precision stored by Si3D.
 # NOTES: 1. The resulting structure will have 3D matrices where the third dimensions is for the time steps. Columns are x and rows are y.
 
 # Author: Sergio Valbuena
@@ -21,152 +23,352 @@ Author: Sam Maksimovich
 
 # Library Import
 import os
+import time
 import numpy as np
-import pandas as pd
-
-# Definition of variable
-def is_eof(f):
-    cur = f.tell()    # save current position
-    f.seek(0, os.SEEK_END)
-    end = f.tell()    # find the size of file
-    f.seek(cur, os.SEEK_SET)
-    return cur == end
-
-def HPlane_Si3dToPython(h_plane_file, dx):
-    fid = open(h_plane_file, "r")
-    dum1 = np.fromfile(fid, count = 1, dtype = np.int32)
-    n_frames = np.fromfile(fid, count = 1, dtype = np.int32)
-    n_frames = n_frames[0]
-    dum2 = np.fromfile(fid, count = 1, dtype = np.int32)
-    dum3 = np.fromfile(fid, count = 1, dtype = np.int32)
-    ipoints = np.fromfile(fid, count = 1, dtype = np.int32)
-    ipoints = ipoints[0] # Number of wet cells in simulation
-    dum4 = np.fromfile(fid, count = 1, dtype = np.int32)
-
-    year = np.empty(n_frames+1)
-    month = np.empty(n_frames+1)
-    day = np.empty(n_frames+1)
-    hour = np.empty(n_frames+1)
-    u = np.empty((ipoints,n_frames+1))
-    v = np.empty((ipoints,n_frames+1))
-    w = np.empty((ipoints,n_frames+1))
-    T = np.empty((ipoints,n_frames+1))
-
-    for frame in range(0,n_frames+1):
-        dum5 = np.fromfile(fid, count = 1, dtype = np.int32)
-        st = is_eof(fid)
-        if st == False:
-            istep = np.fromfile(fid, count = 1, dtype = np.int32)
-            year[frame] = np.fromfile(fid, count = 1, dtype = np.int32)
-            month[frame] = np.fromfile(fid, count = 1, dtype = np.int32)
-            day[frame] = np.fromfile(fid, count = 1, dtype = np.int32)
-            hour[frame] = np.fromfile(fid, count = 1, dtype = np.float32)
-            # ... Read all data for present time slice
-            if frame == 0:
-                # ... GEOMETRY only in first step
-                out_array = np.fromfile(fid,count = 8*ipoints, dtype = np.float32)
-                x = out_array[0:len(out_array)-7:8]
-                y = out_array[1:len(out_array)-6:8]
-                u[:,frame] = out_array[2:len(out_array)-5:8]
-                v[:,frame] = out_array[3:len(out_array)-4:8]
-                w[:,frame] = out_array[4:len(out_array)-3:8]
-                T[:,frame] = out_array[5:len(out_array)-2:8]
-            else:
-                # ... GEOMETRY only in first step
-                out_array = np.fromfile(fid,count = 6*ipoints, dtype = np.float32)
-                u[:,frame] = out_array[0:len(out_array)-5:6]
-                v[:,frame] = out_array[1:len(out_array)-4:6]
-                w[:,frame] = out_array[2:len(out_array)-3:6]
-                T[:,frame] = out_array[3:len(out_array)-2:6]
-            dum6 = np.fromfile(fid,count = 1, dtype = np.int32)
-            del out_array
-        else:
-            n_frames = frame - 1
-            year = year[0:n_frames+1]
-            month = month[0:n_frames+1]
-            day = day[0:n_frames+1]
-            hour = hour[0:n_frames+1]
-            u = u[:,0:n_frames+1]
-            v = v[:,0:n_frames+1]
-            w = w[:,0:n_frames+1]
-            T = T[:,0:n_frames+1]
-            break
-
-    years = year.astype(int)
-    months = month.astype(int)
-    days = day.astype(int)
-    hour /= 100
-    minsec = hour%1
-    hours = hour.astype(int)
-    minsec = hours%1
-    minut = minsec.astype(int)
-    sec = minsec*60
-    df = pd.DataFrame({'year': years, 'month': months, 'day': days, 'hour': hours, 'minute': minut, 'second': sec})
-    Time = pd.to_datetime(df[["year","month","day","hour","minute","second"]])
-
-    x = x.astype(int)
-    y = y.astype(int)
-
-    xv = np.arange(1,max(x),1)
-    yv = np.arange(1,max(y),1)
-    [xg,yg] = np.meshgrid(xv,yv)
-    xg = xg*dx
-    yg = yg*dx
-    [m1,m2] = np.shape(xg)
-
-    ug = np.empty((m1,m2,n_frames+1))
-    ug[:,:] = np.nan
-    vg = np.empty((m1,m2,n_frames+1))
-    vg[:,:] = np.nan
-    wg = np.empty((m1,m2,n_frames+1))
-    wg[:,:] = np.nan
-    Tg = np.empty((m1,m2,n_frames+1))
-    Tg[:,:] = np.nan
-    Azg = np.empty((m1,m2,n_frames+1))
-    Azg[:,:] = np.nan
-    lg = np.empty((m1,m2,n_frames+1))
-    lg[:,:] = np.nan
-
-    for frame in range(0,n_frames+1):
-        # ------- ISOLATE RECORDS FOR a GIVEN TIME STEP
-        # ........ EW_velocity
-        u_vect = u[:,frame]             # [m/s]
-        # ......... NS_velocity
-        v_vect = v[:,frame]             # [m/s]
-        # # ......... Vertical_velocity
-        w_vect = w[:,frame]             # [m/s]
-        # # ......... Scalar field
-        T_vect = T[:,frame]             # [C]
+
+# ... Fortran unformatted records are wrapped by a 4 byte length marker on both sides
+MARKER = np.int32
+
+# ... First two records of the file: number of frames and number of wet cells
+HEADER_DTYPE = np.dtype([
+    ('dum1', MARKER), ('n_frames', np.int32), ('dum2', MARKER),
+    ('dum3', MARKER), ('ipoints', np.int32), ('dum4', MARKER),
+])
+
+# ... Time stamp written at the start of every frame record
+FRAME_HEADER = [
+    ('dum5', MARKER),
+    ('istep', np.int32),
+    ('year', np.int32),
+    ('month', np.int32),
+    ('day', np.int32),
+    ('hour', np.float32),
+]
+
+# ... Values stored for every wet cell. GEOMETRY (x, y) only in first step
+FIRST_POINT_DTYPE = np.dtype([(name, np.float32) for name in ('x', 'y', 'u', 'v', 'w', 'T', 'Az', 'l')])
+POINT_DTYPE = np.dtype([(name, np.float32) for name in ('u', 'v', 'w', 'T', 'Az', 'l')])
+
+
+def first_frame_dtype(ipoints):
+    """ Record layout of the first frame, which also carries the geometry """
+    return np.dtype(FRAME_HEADER + [('data', FIRST_POINT_DTYPE, (ipoints,)), ('dum6', MARKER)])
+
+
+def frame_dtype(ipoints):
+    """ Record layout of every frame after the first """
+    return np.dtype(FRAME_HEADER + [('data', POINT_DTYPE, (ipoints,)), ('dum6', MARKER)])
+
+
+def wet_cell_index(x, y, n_cols):
+    """ Returns the flat index of every wet cell within a (rows, cols) grid
+
+    Args:
+        x (np.ndarray): column of each wet cell, as written by si3d (starts at 2)
+        y (np.ndarray): row of each wet cell, as written by si3d (starts at 2)
+        n_cols (int): number of columns in the grid
+    """
+    return (y - 2) * n_cols + (x - 2)
+
+
+class HPlaneReader:
+    """ Memory-mapped reader for a SI3D H-plane binary file
+
+    The whole file is mapped once and every record is exposed through NumPy structured
+    dtypes, so fields like u, v, w and T are strided views into the file rather than copies.
+    The number of frames is derived from the file size, a trailing partial frame is ignored.
+
+    Example usage:
+    >>> plane = HPlaneReader("./model/psi3d/plane_2")
+    >>> plane.n_frames
+    121
+    >>> plane.field('T', 0)        # zero-copy view of the first frame
+    >>> plane.field('T')           # (ipoints, n_frames) array
+    """
+
+    def __init__(self, h_plane_file):
+        self.path = h_plane_file
+        self.buffer = np.memmap(h_plane_file, dtype=np.uint8, mode='r')
+
+        if len(self.buffer) < HEADER_DTYPE.itemsize:
+            raise ValueError(f"H plane file {h_plane_file} does not contain a complete header")
+        header = self.buffer[:HEADER_DTYPE.itemsize].view(HEADER_DTYPE)[0]
+        self.ipoints = int(header['ipoints'])   # Number of wet cells in simulation
+        n_frames = int(header['n_frames']) + 1   # Upper bound given by the model
+
+        first_dtype = first_frame_dtype(self.ipoints)
+        rest_dtype = frame_dtype(self.ipoints)
+        first_start = HEADER_DTYPE.itemsize
+        rest_start = first_start + first_dtype.itemsize
+
+        if len(self.buffer) < rest_start:
+            raise ValueError(f"H plane file {h_plane_file} does not contain a complete frame")
+
+        n_rest = (len(self.buffer) - rest_start) // rest_dtype.itemsize
+        n_rest = min(n_rest, n_frames - 1)
+        rest_end = rest_start + n_rest * rest_dtype.itemsize
+
+        self.first = self.buffer[first_start:rest_start].view(first_dtype)
+        self.rest = self.buffer[rest_start:rest_end].view(rest_dtype)
+
+    @property
+    def n_frames(self):
+        return 1 + len(self.rest)
+
+    @property
+    def x(self):
+        return self.first['data']['x'][0].astype(int)
+
+    @property
+    def y(self):
+        return self.first['data']['y'][0].astype(int)
+
+    @property
+    def grid_shape(self):
+        """ (rows, cols) of the spatially meaningful domain """
+        return int(self.y.max()) - 1, int(self.x.max()) - 1
+
+    def grid(self, dx):
+        """ Returns the x and y coordinates (m) of every grid cell """
+        n_rows, n_cols = self.grid_shape
+        xg, yg = np.meshgrid(np.arange(1, n_cols + 1), np.arange(1, n_rows + 1))
+        return xg * dx, yg * dx
+
+    def header(self, name):
+        """ Returns a frame header field (istep, year, month, day, hour) for all frames """
+        return np.concatenate([self.first[name], self.rest[name]])
+
+    def field(self, name, frame=None):
+        """ Returns the values of a field (u, v, w, T, Az, l) at every wet cell
+
+        Args:
+            name (str): name of the field
+            frame (int, optional): index of the frame. If given, returns a zero-copy (ipoints,)
+                view of that frame, otherwise an (ipoints, n_frames) array of every frame
+        """
+        if frame is None:
+            return np.concatenate([self.first['data'][name], self.rest['data'][name]]).T
+        if frame == 0:
+            return self.first['data'][name][0]
+        return self.rest['data'][name][frame - 1]
+
+    def time(self):
+        """ Returns the timestamp of every frame formatted as 'YYYY-mm-dd HH' """
+        year, month, day = self.header('year'), self.header('month'), self.header('day')
+        hour = self.header('hour') / 100
+        format_date = lambda y, m, d, h: f"{y:0>4.0f}-{m:0>2.0f}-{d:0>2.0f} {h:0>2.0f}"
+        return [format_date(year[i], month[i], day[i], hour[i]) for i in range(self.n_frames)]
+
+    def grid_field(self, name, dtype=np.float32):
+        """ Returns a (rows, cols, frames) array of a field, NaN on land """
+        n_rows, n_cols = self.grid_shape
+        index = wet_cell_index(self.x, self.y, n_cols)
 
         # ------- ARRANGE RECORDS IN SPATIALLY MEANINGFUL DOMAIN
-        for j in range(int(np.min(y))-2,int(np.max(y)-1)):
-            dum = np.where(y == j+2)
-            # ncols = len(dum)
-            ug[j,x[dum]-2,frame] = u_vect[dum]
-            vg[j,x[dum]-2,frame] = v_vect[dum]
-            wg[j,x[dum]-2,frame] = w_vect[dum]
-            Tg[j,x[dum]-2,frame] = T_vect[dum]
-            del dum
-
-    del dum1, dum2, dum3, dum4, dum5, dum6
-
-    format_date = lambda y, m, d, h: f"{y:0>4.0f}-{m:0>2.0f}-{d:0>2.0f} {h:0>2.0f}"
-    time = [format_date(year[i], month[i], day[i], hour[i]) for i in range(n_frames + 1)]
+        # ... Every frame is scattered at once through the grid cell of each wet point
+        grid = np.full((n_rows, n_cols, self.n_frames), np.nan, dtype=dtype)
+        flat = grid.reshape(n_rows * n_cols, self.n_frames)
+        flat[index, 0] = self.first['data'][name][0]
+        flat[index, 1:] = self.rest['data'][name].T
+        return grid
+
+    def wet_cells(self):
+        """ Returns a (2, ipoints) array with the grid row and column of every wet cell
+
+        This is the shared index of sparse frames, see densify. The grid shape is
+        (rows.max() + 1, cols.max() + 1).
+        """
+        return np.array([self.y - 2, self.x - 2], dtype=np.int32)
+
+    def frames(self, fields=('u', 'v', 'w', 'T'), start=0, dtype=np.float32, sparse=False):
+        """ Yields (timestamp, gridded frame) one frame at a time
+
+        Only a single frame is gridded at once, so memory does not grow with the length
+        of the simulation.
+
+        Args:
+            fields (tuple, optional): fields to grid, returned as '<field>g' in the frame dictionary
+            start (int, optional): index of the first frame to yield
+            dtype (np.dtype, optional): dtype of the gridded frames
+            sparse (bool, optional): if True, frames are not gridded. Each field is returned as
+                '<field>' with only the (ipoints,) wet cell values, ordered as in wet_cells()
+
+        Example usage:
+        >>> for timestamp, frame in plane.frames(('u', 'v')):
+        ...     uv = np.array([frame['ug'], frame['vg']])
+        """
+        n_rows, n_cols = self.grid_shape
+        index = wet_cell_index(self.x, self.y, n_cols)
+        timestamps = self.time()
+        for frame in range(start, self.n_frames):
+            timestamp = timestamps[frame]
+            gridded = {}
+            for name in fields:
+                if sparse:
+                    gridded[name] = self.field(name, frame).astype(dtype)
+                    continue
+                grid = np.full(n_rows * n_cols, np.nan, dtype=dtype)
+                grid[index] = self.field(name, frame)
+                gridded[f"{name}g"] = grid.reshape(n_rows, n_cols)
+            yield timestamp, gridded
+
+
+def follow_frames(h_plane_file, is_running, fields=('u', 'v', 'w', 'T'), poll_interval=5, dtype=np.float32, sparse=False):
+    """ Yields (timestamp, gridded frame) from a plane file that si3d is still writing
+
+    The file is polled until it stops growing, and a frame is only yielded once its whole
+    Fortran record has been written. This lets frames be processed while the model runs.
+
+    Args:
+        h_plane_file (str): path to the plane file
+        is_running (callable): returns True while the model may still write to the file
+        fields (tuple, optional): fields to grid, see HPlaneReader.frames
+        poll_interval (float, optional): seconds to wait before checking the file again
+        dtype (np.dtype, optional): dtype of the gridded frames
+        sparse (bool, optional): yield wet cell values only, see HPlaneReader.frames
+
+    Example usage:
+    >>> model = threading.Thread(target=run_si3d)
+    >>> model.start()
+    >>> for timestamp, frame in follow_frames("./model/psi3d/plane_2", model.is_alive):
+    ...     np.save(f"{timestamp}.npy", frame['Tg'])
+    """
+    n_yielded = 0
+    while True:
+        # Checked before reading, so frames written right before the model exits are not missed
+        running = is_running()
+
+        plane = None
+        if os.path.isfile(h_plane_file):
+            try:
+                plane = HPlaneReader(h_plane_file)
+            except ValueError:
+                # The model has not written the first frame yet
+                if not running:
+                    raise
+
+        if plane is not None:
+            for timestamp, frame in plane.frames(fields, start=n_yielded, dtype=dtype, sparse=sparse):
+                n_yielded += 1
+                yield timestamp, frame
+            del plane
+
+        if not running:
+            if n_yielded == 0:
+                raise FileNotFoundError(f"si3d finished without writing h plane file {h_plane_file}")
+            return
+        time.sleep(poll_interval)
+
+
+def densify(values, grid_index):
+    """ Rebuilds NaN padded (..., rows, cols) grids from sparse wet cell values
+
+    Args:
+        values (np.ndarray): (..., ipoints) wet cell values, e.g. a sparse (2, ipoints) flow frame
+        grid_index (np.ndarray): (2, ipoints) row and column of every wet cell, see HPlaneReader.wet_cells
+    """
+    rows, cols = grid_index
+    grid = np.full(values.shape[:-1] + (rows.max() + 1, cols.max() + 1), np.nan, dtype=values.dtype)
+    grid[..., rows, cols] = values
+    return grid
+
+
+def block_average(grid, factor):
+    """ Averages (..., rows, cols) grids over factor x factor blocks of cells, ignoring land (NaN)
+
+    The grid is padded with land up to a multiple of factor, so a 174 x 102 grid at 200 m
+    becomes 44 x 26 at 800 m like the h800 bathymetry. Blocks without water are NaN.
+
+    Args:
+        grid (np.ndarray): (..., rows, cols) NaN padded grid, e.g. a dense (2, rows, cols) flow frame
+        factor (int): number of cells along each side of a block
+    """
+    n_rows, n_cols = grid.shape[-2:]
+    pad_rows, pad_cols = -n_rows % factor, -n_cols % factor
+    padding = [(0, 0)] * (grid.ndim - 2) + [(0, pad_rows), (0, pad_cols)]
+    padded = np.pad(grid, padding, constant_values=np.nan)
+
+    blocks = padded.reshape(grid.shape[:-2] + ((n_rows + pad_rows) // factor, factor, (n_cols + pad_cols) // factor, factor))
+    water = ~np.isnan(blocks)
+    total = np.where(water, blocks, 0).sum(axis=(-3, -1))
+    count = water.sum(axis=(-3, -1))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (total / count).astype(grid.dtype)
+
+
+# ... Compact encodings of published frames. Values are stored as (value - offset) / scale
+ENCODINGS = ('float32', 'float16', 'int16')
+INT16_NAN = np.iinfo(np.int16).min   # int16 has no NaN, land cells are stored as this value
+
+
+def encoding_metadata(encoding='float32', offset=0.0, scale=1.0):
+    """ Describes how a field is encoded, published next to the encoded frames
+
+    Args:
+        encoding (str, optional): one of ENCODINGS
+        offset (float, optional): value subtracted before encoding
+        scale (float, optional): resolution of the encoded values, e.g. 0.001 for int16 temperature
+            keeps 3 decimals over -32.767 to 32.767 around the offset
+    """
+    if encoding not in ENCODINGS:
+        raise ValueError(f"Unknown encoding {encoding}, expected one of {ENCODINGS}")
+    metadata = {'encoding': encoding, 'offset': offset, 'scale': scale}
+    if encoding == 'int16':
+        metadata['nan'] = int(INT16_NAN)
+    return metadata
+
+
+def encode(values, metadata):
+    """ Encodes float values as described by encoding_metadata """
+    scaled = (np.asarray(values, dtype=np.float32) - metadata['offset']) / metadata['scale']
+    if metadata['encoding'] != 'int16':
+        return scaled.astype(metadata['encoding'])
+
+    limits = np.iinfo(np.int16)
+    encoded = np.clip(np.rint(scaled), limits.min + 1, limits.max)
+    encoded[np.isnan(scaled)] = INT16_NAN
+    return encoded.astype(np.int16)
+
+
+def decode(encoded, metadata):
+    """ Decodes frames produced by encode back to float32, land cells are NaN again
+
+    Example usage:
+    >>> metadata = encoding_metadata('int16', scale=0.001)
+    >>> t = decode(np.load("./outputs/temperature/2022-05-09 02.npy"), metadata)
+    """
+    values = encoded.astype(np.float32)
+    if metadata['encoding'] == 'int16':
+        values[encoded == metadata['nan']] = np.nan
+    return values * np.float32(metadata['scale']) + np.float32(metadata['offset'])
+
+
+def HPlane_Si3dToPython(h_plane_file, dx, fields=('u', 'v', 'w', 'T'), dtype=np.float32, raw=False):
+    """ Reads a plane file into gridded (rows, cols, frames) arrays
+
+    Args:
+        h_plane_file (str): path to the plane file
+        dx (float): cell size of the simulation (m)
+        fields (tuple, optional): fields to grid, returned as '<field>g'. Cubes of fields
+            that are not selected are never allocated
+        dtype (np.dtype, optional): dtype of the returned arrays, defaults to the float32
+            values stored in the file
+        raw (bool, optional): if True, also returns the (ipoints, frames) values of every
+            selected field as '<field>'
+    """
+    plane = HPlaneReader(h_plane_file)
+
+    xg, yg = plane.grid(dx)
+
     output = {}
-    output['time'] = time
+    output['time'] = plane.time()
     output['xg'] = xg
     output['yg'] = yg
-    output['ug'] = ug
-    output['vg'] = vg
-    output['wg'] = wg
-    output['Tg'] = Tg
-    output['T'] = T
-    output['x'] = x
-    output['y'] = y
-    output['u'] = u
-    output['v'] = v
-    output['w'] = w
-
-    fid.close()
+    output['x'] = plane.x
+    output['y'] = plane.y
+    for name in fields:
+        output[f"{name}g"] = plane.grid_field(name, dtype)
+        if raw:
+            output[name] = plane.field(name).astype(dtype)
 
     return output
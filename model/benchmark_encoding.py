@@ -0,0 +1,64 @@
+"""
+Use this script to compare the encodings of published flow and temperature frames.
+- For every encoding and lossless compressor, reports the bytes per frame (flow + temperature),
+the max absolute error of each field after decoding and the encode + decode time, on a
+synthetic 14 day plane file.
+
+Run from the root of the repository:
+
+`python -m model.benchmark_encoding`
+"""
+
+import os
+import time
+import tempfile
+import numpy as np
+from model.HPlane_Si3DtoPython import HPlaneReader, ENCODINGS, encoding_metadata, encode, decode
+from model.benchmark_hplane import write_synthetic_plane, DAYS, FRAMES_PER_DAY
+from model.create_output_binary import FIELD_SCALING
+from model.run_archive import COMPRESSORS
+
+
+def benchmark_encoding(frames, encoding, compression, sparse):
+    compress, decompress = COMPRESSORS[compression]
+    scaling = FIELD_SCALING if encoding == "int16" else {}
+    metadata = {name: encoding_metadata(encoding, *scaling.get(name, (0.0, 1.0))) for name in FIELD_SCALING}
+
+    n_bytes = 0
+    max_error = {name: 0.0 for name in FIELD_SCALING}
+    start = time.perf_counter()
+    for frame in frames:
+        for name, values in frame.items():
+            chunk = compress(encode(values, metadata[name]).tobytes())
+            n_bytes += len(chunk)
+
+            dtype = np.int16 if encoding == "int16" else encoding
+            decoded = decode(np.frombuffer(decompress(chunk), dtype=dtype).reshape(values.shape), metadata[name])
+            assert np.array_equal(np.isnan(decoded), np.isnan(values)), "Land cells changed"
+            max_error[name] = max(max_error[name], float(np.nanmax(np.abs(decoded - values))))
+    elapsed = time.perf_counter() - start
+
+    layout = "sparse" if sparse else "dense"
+    errors = "".join(f"{max_error[name]:>20.2e}" for name in FIELD_SCALING)
+    print(f"{layout:<8}{encoding:<10}{str(compression):<8}{n_bytes / len(frames):>14.0f}{errors}{elapsed * 1000 / len(frames):>12.2f}")
+
+
+if __name__ == "__main__":
+    n_frames = DAYS * FRAMES_PER_DAY + 1
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        plane_path = os.path.join(tmp_dir, "plane_2")
+        write_synthetic_plane(plane_path, n_frames)
+        plane = HPlaneReader(plane_path)
+
+        errors = "".join(f"{name + ' error':>20}" for name in FIELD_SCALING)
+        print(f"{'layout':<8}{'encoding':<10}{'codec':<8}{'bytes/frame':>14}{errors}{'ms/frame':>12}")
+        for sparse in (False, True):
+            suffix = "" if sparse else "g"
+            frames = [
+                {"flow": np.array([frame['u' + suffix], frame['v' + suffix]]), "temperature": frame['T' + suffix]}
+                for _, frame in plane.frames(('u', 'v', 'T'), sparse=sparse)
+            ]
+            for encoding in ENCODINGS:
+                for compression in COMPRESSORS:
+                    benchmark_encoding(frames, encoding, compression, sparse)
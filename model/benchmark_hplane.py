@@ -0,0 +1,125 @@
+"""
+Use this script to benchmark the H-plane reader on a synthetic plane file.
+- The synthetic file uses the wet cells of the bathymetry file `h` (102 x 174 grid)
+and has one frame every 2 hours, like the output of si3d_inp.txt (iht = 720).
+
+Run from the root of the repository:
+
+`python -m model.benchmark_hplane`
+"""
+
+import os
+import time
+import tempfile
+import numpy as np
+from model.HPlane_Si3DtoPython import HPlaneReader, wet_cell_index
+
+BATHYMETRY_PATH = "./model/psi3d/h"
+DAYS = 14
+FRAMES_PER_DAY = 12           # 2 hour cadence
+START_DATE = np.datetime64("2022-05-09T02")
+
+
+def read_wet_cells(bathymetry_path=BATHYMETRY_PATH):
+    """ Returns the (x, y) si3d coordinates of every wet cell in a bathymetry file
+
+    The first 3 lines of the file are headers, every other line starts with the row
+    index followed by one depth per column. Land is marked with -99.
+    """
+    with open(bathymetry_path, "r") as file:
+        lines = file.readlines()[3:]
+
+    rows = np.array([list(map(int, line.split())) for line in lines if line.strip()])
+    row_index, depths = rows[:, 0], rows[:, 1:]
+    wet_rows, wet_cols = np.nonzero(depths != -99)
+    return wet_cols + 2, row_index[wet_rows]
+
+
+def write_synthetic_plane(file_path, n_frames, bathymetry_path=BATHYMETRY_PATH, seed=0):
+    """ Writes a plane file with synthetic values laid out like si3d's H-plane output
+
+    Args:
+        file_path (str): path of the plane file to create
+        n_frames (int): number of frames to write
+        bathymetry_path (str, optional): bathymetry file used to place the wet cells
+        seed (int, optional): seed of the random noise
+    """
+    rng = np.random.default_rng(seed)
+    x, y = read_wet_cells(bathymetry_path)
+    ipoints = len(x)
+
+    with open(file_path, "wb") as file:
+        np.array([4, n_frames - 1, 4, 4, ipoints, 4], dtype=np.int32).tofile(file)
+        for frame in range(n_frames):
+            n_values = 8 if frame == 0 else 6
+            record_size = 20 + 4 * n_values * ipoints
+
+            date = (START_DATE + np.timedelta64(2 * frame, 'h')).astype(object)
+            np.array([record_size, 720 * frame, date.year, date.month, date.day], dtype=np.int32).tofile(file)
+            np.array([100 * date.hour], dtype=np.float32).tofile(file)
+
+            # Smooth surface fields with a little noise, in the range of Lake Tahoe values
+            phase = 2 * np.pi * frame / FRAMES_PER_DAY
+            noise = rng.standard_normal((4, ipoints))
+            u = 0.2 * np.sin(2 * np.pi * y / 40 + phase) + 0.01 * noise[0]    # [m/s]
+            v = 0.2 * np.cos(2 * np.pi * x / 30 + phase) + 0.01 * noise[1]    # [m/s]
+            w = 1e-4 * noise[2]                                                # [m/s]
+            T = 12 + 4 * np.sin(np.pi * y / 174) + np.cos(2 * np.pi * x / 102 + phase) + 0.05 * noise[3]   # [C]
+            Az, l = rng.random((2, ipoints))
+            fields = [u, v, w, T, Az, l] if frame > 0 else [x, y, u, v, w, T, Az, l]
+            np.array(fields, dtype=np.float32).T.tofile(file)
+            np.array([record_size], dtype=np.int32).tofile(file)
+
+
+def grid_with_loop(x, y, n_rows, n_cols, fields):
+    """ Gridding as originally done in HPlane_Si3dToPython, one row at a time for every frame """
+    n_frames = fields[0].shape[1]
+    grids = [np.full((n_rows, n_cols, n_frames), np.nan) for _ in fields]
+    for frame in range(n_frames):
+        for j in range(int(np.min(y)) - 2, int(np.max(y) - 1)):
+            dum = np.where(y == j + 2)
+            for grid, field in zip(grids, fields):
+                grid[j, x[dum] - 2, frame] = field[dum, frame]
+    return grids
+
+
+def grid_with_scatter(x, y, n_rows, n_cols, fields):
+    """ Gridding as done in HPlane_Si3dToPython, a single scatter for all frames """
+    n_frames = fields[0].shape[1]
+    index = wet_cell_index(x, y, n_cols)
+    grids = [np.full((n_rows, n_cols, n_frames), np.nan) for _ in fields]
+    for grid, field in zip(grids, fields):
+        grid.reshape(n_rows * n_cols, -1)[index] = field
+    return grids
+
+
+def benchmark(label, function, *args, repeat=3):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        timings.append(time.perf_counter() - start)
+    print(f"{label:<30} best of {repeat}: {min(timings) * 1000:>10.2f} ms")
+    return result, min(timings)
+
+
+if __name__ == "__main__":
+    n_frames = DAYS * FRAMES_PER_DAY + 1
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        plane_path = os.path.join(tmp_dir, "plane_2")
+        write_synthetic_plane(plane_path, n_frames)
+        print(f"Synthetic plane file: {n_frames} frames, {os.path.getsize(plane_path) / 1e6:.1f} MB")
+
+        plane = HPlaneReader(plane_path)
+        x, y = plane.x, plane.y
+        fields = [plane.field(name).astype(np.float64) for name in ('u', 'v', 'w', 'T')]
+        n_rows, n_cols = int(max(y)) - 1, int(max(x)) - 1
+        print(f"Grid (rows, cols) = {(n_rows, n_cols)}, ipoints = {plane.ipoints}")
+
+        loop, loop_time = benchmark("Row loop gridding", grid_with_loop, x, y, n_rows, n_cols, fields, repeat=1)
+        scatter, scatter_time = benchmark("Scatter gridding", grid_with_scatter, x, y, n_rows, n_cols, fields)
+
+        for a, b in zip(loop, scatter):
+            assert np.array_equal(a, b, equal_nan=True), "Scatter gridding does not match the row loop"
+        print(f"Speedup: {loop_time / scatter_time:.1f}x")
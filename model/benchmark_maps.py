@@ -0,0 +1,112 @@
+"""
+Use this script to measure how many flow and temperature maps per second create_output_maps
+renders, before (new quiver, mesh and colorbar on every frame) and after (artists reused),
+and how many temperature tiles per second create_tiles renders without matplotlib.
+
+Run from the root of the repository:
+
+`python -m model.benchmark_maps`
+"""
+
+import matplotlib
+matplotlib.use("Agg")
+
+import os
+import time
+import tempfile
+from matplotlib import pyplot as plt
+from model import create_outputs, create_tiles
+from model.hplane_cache import CachedPlane
+from model.benchmark_hplane import write_synthetic_plane
+
+N_FRAMES = 13               # 1 day of 2 hour frames
+
+
+def render_flow_maps_legacy(frame_indices):
+    # Flow maps as originally rendered by create_output_maps
+    h_plane = CachedPlane(create_outputs.H_PLANE_PATH)
+    timestamps = h_plane.time()
+    xg, yg = h_plane.grid(create_outputs.DX)
+    fig, ax = plt.subplots(1, 1)
+    ax.text(0.7, 0.882, "m/s", transform=fig.transFigure)
+    cbar = surface_flow = None
+    for idx in frame_indices:
+        if cbar is not None or surface_flow is not None:
+            cbar.remove()
+            surface_flow.remove()
+        u, v, w = h_plane.cube('u')[idx], h_plane.cube('v')[idx], h_plane.cube('w')[idx]
+        magnitude = (u**2 + v**2 + w**2)**0.5
+        surface_flow = ax.quiver(xg, yg, u, v, magnitude, cmap='Spectral_r', scale=4, scale_units='inches',
+                                 headwidth=3, headlength=5, headaxislength=10, width=0.008)
+        cax = plt.axes([0.7, 0.125, 0.02, 0.75])
+        cbar = fig.colorbar(surface_flow, cax=cax)
+        cbar.ax.tick_params(labelsize=9)
+        fig.suptitle(timestamps[idx] + ":00")
+        ax.set_aspect('equal')
+        ax.axis('off')
+        plt.savefig(create_outputs.OUTPUT_DIR + create_outputs.FLOW_DIR + f'flow_{timestamps[idx]}', bbox_inches='tight')
+        plt.cla()
+    plt.close()
+
+
+def render_temperature_maps_legacy(frame_indices):
+    # Temperature maps as originally rendered by create_output_maps
+    h_plane = CachedPlane(create_outputs.H_PLANE_PATH)
+    timestamps = h_plane.time()
+    xg, yg = h_plane.grid(create_outputs.DX)
+    fig, ax = plt.subplots(1, 1)
+    ax.text(0.7, 0.882, "° Celsius", transform=fig.transFigure)
+    cbar = temp_map = None
+    for idx in frame_indices:
+        if cbar is not None or temp_map is not None:
+            cbar.remove()
+            temp_map.remove()
+        temp_map = ax.pcolormesh(xg, yg, h_plane.cube('T')[idx], shading='gouraud', cmap='RdYlBu_r')
+        cax = plt.axes([0.7, 0.125, 0.02, 0.75])
+        cbar = fig.colorbar(temp_map, cax=cax)
+        cbar.ax.tick_params(labelsize=9)
+        fig.suptitle(timestamps[idx] + ":00")
+        ax.set_aspect('equal')
+        ax.axis('off')
+        plt.savefig(create_outputs.OUTPUT_DIR + create_outputs.TEMPERATURE_DIR + f'temperature_{timestamps[idx]}', bbox_inches='tight')
+        plt.cla()
+    plt.close()
+
+
+def render_temperature_tiles(frame_indices):
+    h_plane = CachedPlane(create_outputs.H_PLANE_PATH)
+    timestamps = h_plane.time()
+    for idx in frame_indices:
+        with open(create_outputs.OUTPUT_DIR + create_outputs.TEMPERATURE_DIR + f'temperature_{timestamps[idx]}.png', 'wb') as file:
+            file.write(create_tiles.temperature_tile(h_plane.cube('T')[idx]))
+
+
+def frames_per_second(label, renderer, n_frames):
+    start = time.perf_counter()
+    renderer(list(range(n_frames)))
+    elapsed = time.perf_counter() - start
+    print(f"{label:<40} {n_frames / elapsed:>8.2f} frames/s")
+    return n_frames / elapsed
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        create_outputs.H_PLANE_PATH = os.path.join(tmp_dir, "plane_2")
+        create_outputs.OUTPUT_DIR = os.path.join(tmp_dir, "outputs/")
+        for directory in (create_outputs.FLOW_DIR, create_outputs.TEMPERATURE_DIR):
+            os.makedirs(create_outputs.OUTPUT_DIR + directory)
+
+        write_synthetic_plane(create_outputs.H_PLANE_PATH, N_FRAMES)
+        for name in ('u', 'v', 'w', 'T'):
+            CachedPlane(create_outputs.H_PLANE_PATH).cube(name)
+
+        for name, legacy, renderer in [
+            ("flow", render_flow_maps_legacy, create_outputs.render_flow_maps),
+            ("temperature", render_temperature_maps_legacy, create_outputs.render_temperature_maps),
+        ]:
+            before = frames_per_second(f"{name} maps, new artists every frame", legacy, N_FRAMES)
+            after = frames_per_second(f"{name} maps, reused artists", renderer, N_FRAMES)
+            print(f"{name} speedup: {after / before:.1f}x")
+
+        tiles = frames_per_second("temperature tiles, lookup table", render_temperature_tiles, N_FRAMES)
+        print(f"temperature tiles speedup over reused artists: {tiles / after:.0f}x")
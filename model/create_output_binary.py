@@ -1,14 +1,29 @@
-from model.HPlane_Si3DtoPython import HPlane_Si3dToPython
+from model.HPlane_Si3DtoPython import HPlaneReader, follow_frames, encoding_metadata, encode, densify, block_average
+from model.run_archive import RunArchive
+from model.hplane_cache import CachedPlane
 import numpy as np
-import os, logging
+import os, json, logging
 
 ##############################################################
 # User Config
 OUTPUT_DIR = "./outputs/"                     # Output file directory
 H_PLANE_PATH = "./model/psi3d/plane_2"        # Path to model output file
 DX = 200                                      # idx parameter from simulation
+DTYPE = np.float32                            # dtype of saved arrays, si3d writes float32
+OUTPUT_FORMAT = "dense"                       # "dense" (rows, cols) grids or "sparse" wet cell values
+GRID_INDEX_FILE = "grid_index.npy"            # (2, ipoints) row and column of each wet cell, sparse only
 FLOW_DIR = "flow/"
 TEMPERATURE_DIR = "temperature/"
+ARCHIVE_DIR = "archive/"
+OUTPUT_CONTAINER = "npy"                      # "npy" files per frame or a single run "archive"
+ARCHIVE_COMPRESSION = "zlib"                  # Lossless compressor of archive chunks, see run_archive.COMPRESSORS
+ENCODING = "float32"                          # "float32", "float16" or scaled "int16" saved values
+FIELD_SCALING = {                             # (offset, scale) of each field, used by int16
+    "flow": (0.0, 0.0001),                    # 0.1 mm/s resolution up to +-3.2 m/s
+    "temperature": (0.0, 0.001),              # 0.001 C resolution up to +-32 C
+}
+ENCODING_FILE = "encoding.json"               # Encoding metadata of npy outputs, unless float32
+PYRAMID_LEVELS = (400, 800)                   # Coarser resolutions (m) saved next to the DX grid, () to disable
 ##############################################################
 
 logFilename = "logs/s3_log.log"
@@ -19,14 +34,49 @@ logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(message)s"
 )
 
-def create_output_binary():
-    h_plane = HPlane_Si3dToPython(H_PLANE_PATH, DX)
+def create_output_binary(follow=None, on_frame=None):
+    """ Parses the h plane file into a flow and a temperature .npy file per frame
 
-    n_rows, n_cols, n_frames = h_plane['Tg'].shape
-    str1 = "Found h plane file"
-    str2 = f"Map dimensions (row, cols, n_frames) = {(n_rows, n_cols, n_frames)}"
-    msg = f"{str1}\n{str2}"
-    logging.info(msg)
+    Args:
+        follow (callable, optional): returns True while si3d is running. If given, frames are
+            converted as soon as the model writes them instead of after the simulation
+        on_frame (callable, optional): called with the flow and temperature file paths of
+            every saved frame, followed by the file paths of its pyramid levels
+
+    In the "sparse" OUTPUT_FORMAT, flow files contain a (2, ipoints) array and temperature
+    files an (ipoints,) array with only the wet cells. The dense grid can be rebuilt with
+    GRID_INDEX_FILE, see HPlane_Si3DtoPython.densify.
+
+    With the "archive" OUTPUT_CONTAINER, every frame is written to a single compressed run
+    archive in ARCHIVE_DIR instead (see model/run_archive.py), and on_frame is not called.
+
+    With a compact ENCODING, the saved arrays hold encoded values. Their metadata is written
+    to ENCODING_FILE (or the archive manifest), decode them with HPlane_Si3DtoPython.decode.
+
+    Every PYRAMID_LEVELS resolution is saved as block averaged (rows, cols) grids in
+    flow_<level>m/ and temperature_<level>m/ next to FLOW_DIR and TEMPERATURE_DIR (or as
+    flow_<level>m and temperature_<level>m archive fields), in both OUTPUT_FORMATs.
+    """
+    fields = ('u', 'v', 'T')
+    sparse = (OUTPUT_FORMAT == "sparse")
+    for level in PYRAMID_LEVELS:
+        if level % DX != 0:
+            raise ValueError(f"Pyramid level {level} m is not a multiple of the grid resolution {DX} m")
+    pyramid = {f"{level}m": level // DX for level in PYRAMID_LEVELS}
+    if follow is None:
+        # Gridded once and shared with other consumers of this run, e.g. create_output_maps
+        h_plane = CachedPlane(H_PLANE_PATH)
+        frames = h_plane.frames(fields, dtype=DTYPE, sparse=sparse)
+
+        n_rows, n_cols = h_plane.grid_shape
+        n_frames = h_plane.n_frames
+        str1 = "Found h plane file"
+        str2 = f"Map dimensions (row, cols, n_frames) = {(n_rows, n_cols, n_frames)}"
+        msg = f"{str1}\n{str2}"
+        logging.info(msg)
+    else:
+        frames = follow_frames(H_PLANE_PATH, follow, fields, dtype=DTYPE, sparse=sparse)
+        logging.info(f"Following h plane file {H_PLANE_PATH} while si3d is running")
 
     # Create output directories if they don't exist
     if not os.path.isdir(OUTPUT_DIR):
@@ -37,18 +87,90 @@ def create_output_binary():
         os.mkdir(OUTPUT_DIR + TEMPERATURE_DIR)
     if not os.path.isdir(OUTPUT_DIR + "flow/"):
         os.mkdir(OUTPUT_DIR + FLOW_DIR)
+    if OUTPUT_CONTAINER == "npy":
+        for level in pyramid:
+            os.makedirs(OUTPUT_DIR + f"flow_{level}/", exist_ok=True)
+            os.makedirs(OUTPUT_DIR + f"temperature_{level}/", exist_ok=True)
 
-    for idx, timestamp in enumerate(h_plane['time']):
-        u = h_plane['ug'][:, :, idx]
-        v = h_plane['vg'][:, :, idx]
-        uv = np.array([u, v])
-        np.save(OUTPUT_DIR + FLOW_DIR + timestamp + '.npy', uv)
+    # Offset and scale only matter for int16, float encodings keep the values as they are
+    scaling = FIELD_SCALING if ENCODING == "int16" else {}
+    encodings = {
+        name: encoding_metadata(ENCODING, *scaling.get(name, (0.0, 1.0)))
+        for name in ("flow", "temperature")
+    }
+    for level in pyramid:
+        encodings[f"flow_{level}"] = encodings["flow"]
+        encodings[f"temperature_{level}"] = encodings["temperature"]
+    if ENCODING != "float32" and OUTPUT_CONTAINER == "npy":
+        with open(OUTPUT_DIR + ENCODING_FILE, "w") as file:
+            json.dump(encodings, file)
+        logging.info(f"Saved {ENCODING} encoding metadata {OUTPUT_DIR + ENCODING_FILE}")
+    elif os.path.isfile(OUTPUT_DIR + ENCODING_FILE):
+        # Metadata of a previous run, these outputs are not encoded
+        os.remove(OUTPUT_DIR + ENCODING_FILE)
 
-        t = h_plane['Tg'][:, :, idx]
-        np.save(OUTPUT_DIR + TEMPERATURE_DIR + timestamp + '.npy', t)
-        str1 = f"Saved uv and temperature at {timestamp}"
-        logging.info(str1)
+    archive = None
+    if OUTPUT_CONTAINER == "archive":
+        archive = RunArchive(OUTPUT_DIR + ARCHIVE_DIR, compression=ARCHIVE_COMPRESSION, encodings=encodings)
+
+    try:
+        # Frames are gridded one at a time, so memory does not grow with the simulation length
+        suffix = "" if sparse else "g"
+        for idx, (timestamp, frame) in enumerate(frames):
+            if sparse and idx == 0:
+                # The first frame carries the geometry, so it is complete once a frame is available
+                grid_index = HPlaneReader(H_PLANE_PATH).wet_cells()
+                np.save(OUTPUT_DIR + GRID_INDEX_FILE, grid_index)
+                logging.info(f"Saved grid index {OUTPUT_DIR + GRID_INDEX_FILE}")
+
+            u = frame['u' + suffix]
+            v = frame['v' + suffix]
+            uv = np.array([u, v])
+            t = frame['T' + suffix]
 
+            # Coarser levels are always dense grids, they are small
+            levels = {}
+            if len(pyramid) > 0:
+                uv_grid = densify(uv, grid_index) if sparse else uv
+                t_grid = densify(t, grid_index) if sparse else t
+                for level, factor in pyramid.items():
+                    levels[f"flow_{level}"] = encode(block_average(uv_grid, factor), encodings[f"flow_{level}"])
+                    levels[f"temperature_{level}"] = encode(block_average(t_grid, factor), encodings[f"temperature_{level}"])
+
+            uv = encode(uv, encodings["flow"])
+            t = encode(t, encodings["temperature"])
+
+            if archive is not None:
+                archive.add(timestamp, flow=uv, temperature=t, **levels)
+                str1 = f"Archived uv and temperature at {timestamp}"
+                logging.info(str1)
+                continue
+
+            flow_path = OUTPUT_DIR + FLOW_DIR + timestamp + '.npy'
+            np.save(flow_path, uv)
+
+            temperature_path = OUTPUT_DIR + TEMPERATURE_DIR + timestamp + '.npy'
+            np.save(temperature_path, t)
+
+            level_paths = []
+            for name, values in levels.items():
+                level_paths.append(OUTPUT_DIR + f"{name}/" + timestamp + '.npy')
+                np.save(level_paths[-1], values)
+            str1 = f"Saved uv and temperature at {timestamp}"
+            logging.info(str1)
+
+            if on_frame is not None:
+                on_frame(flow_path, temperature_path, *level_paths)
+    except BaseException:
+        # A failed run leaves no partial archive behind
+        if archive is not None:
+            archive.discard()
+        raise
+
+    if archive is not None:
+        archive_path, manifest_path = archive.close()
+        str1 = f"Saved run archive {archive_path} with manifest {manifest_path}"
+        logging.info(str1)
 
 
 if __name__ == '__main__':
@@ -1,5 +1,8 @@
 from matplotlib import pyplot as plt
-from .HPlane_Si3DtoPython import HPlane_Si3dToPython
+from concurrent.futures import ProcessPoolExecutor
+from .hplane_cache import CachedPlane
+import numpy as np
+import argparse
 import time
 import os, logging, sys
 
@@ -8,6 +11,9 @@ import os, logging, sys
 OUTPUT_DIR = "./model/outputs/"                     # Output file directory
 H_PLANE_PATH = "./model/psi3d/plane_2"        # Path to model output file
 DX = 200                                      # idx parameter from simulation
+FLOW_DIR = "flow/"
+TEMPERATURE_DIR = "temperature/"
+LAYOUT_PAD_INCHES = 0.15                      # Padding around the maps when saved
 ##############################################################
 
 logFilename = "logs/s3_log.log"
@@ -20,7 +26,143 @@ logging.basicConfig(
     ]
 )
 
-def create_output_maps():
+def render_flow_maps(frame_indices):
+    """ Renders the flow map of the given frames in a figure owned by this process
+
+    The figure, quiver and colorbar are created once, every frame only updates their data.
+
+    Args:
+        frame_indices (List[int]): frames to render
+    """
+    if len(frame_indices) == 0:
+        return 0
+
+    # Cubes are memory-mapped from the cache, so every worker shares them without copies
+    h_plane = CachedPlane(H_PLANE_PATH)
+    timestamps = h_plane.time()
+    xg, yg = h_plane.grid(DX)
+    ug, vg, wg = h_plane.cube('u'), h_plane.cube('v'), h_plane.cube('w')
+
+    fig, ax = plt.subplots(1, 1)
+    ax.text(0.7, 0.882, "m/s", transform=fig.transFigure)
+    ax.set_aspect('equal')
+    ax.axis('off')
+    title = fig.suptitle("")
+
+    # The first frame's magnitude gives the colorbar an array and limits before it is attached
+    first = frame_indices[0]
+    surface_flow = ax.quiver(
+        xg, 
+        yg, 
+        ug[first], 
+        vg[first], 
+        (ug[first]**2 + vg[first]**2 + wg[first]**2)**0.5,
+        cmap='Spectral_r', 
+        scale=4, 
+        scale_units='inches', 
+        headwidth=3, 
+        headlength=5, 
+        headaxislength=10, 
+        width=0.008
+    )
+    cax = fig.add_axes([0.7, 0.125, 0.02, 0.75])
+    cbar = fig.colorbar(surface_flow, cax=cax)
+    cbar.ax.tick_params(labelsize=9)
+
+    bbox = None
+    for idx in frame_indices:
+        timestamp = timestamps[idx]
+        u = ug[idx]
+        v = vg[idx]
+        w = wg[idx]
+        magnitude = (u**2 + v**2 + w**2)**0.5
+        surface_flow.set_UVC(u, v, magnitude)
+        surface_flow.autoscale()   # Colorbar follows the range of this frame
+        title.set_text(timestamp + ":00")
+
+        bbox = bbox or tight_bbox(fig)
+        fig.savefig(OUTPUT_DIR + FLOW_DIR + f'flow_{timestamp}', bbox_inches=bbox)
+        str1 = f"Created output flow map for {timestamp}"
+        logging.info(str1)
+    plt.close(fig)
+    return len(frame_indices)
+
+
+def render_temperature_maps(frame_indices):
+    """ Renders the temperature map of the given frames in a figure owned by this process
+
+    The figure, mesh and colorbar are created once, every frame only updates their data.
+
+    Args:
+        frame_indices (List[int]): frames to render
+    """
+    if len(frame_indices) == 0:
+        return 0
+
+    h_plane = CachedPlane(H_PLANE_PATH)
+    timestamps = h_plane.time()
+    xg, yg = h_plane.grid(DX)
+    Tg = h_plane.cube('T')
+
+    fig, ax = plt.subplots(1, 1)
+    ax.text(0.7, 0.882, "° Celsius", transform=fig.transFigure)
+    ax.set_aspect('equal')
+    ax.axis('off')
+    title = fig.suptitle("")
+
+    temp_map = ax.pcolormesh(xg, yg, Tg[frame_indices[0]], shading='gouraud', cmap='RdYlBu_r')
+    cax = fig.add_axes([0.7, 0.125, 0.02, 0.75])
+    cbar = fig.colorbar(temp_map, cax=cax)
+    cbar.ax.tick_params(labelsize=9)
+
+    bbox = None
+    for idx in frame_indices:
+        timestamp = timestamps[idx]
+        temp_map.set_array(Tg[idx])
+        temp_map.autoscale()   # Colorbar follows the range of this frame
+        title.set_text(timestamp + ":00")
+
+        bbox = bbox or tight_bbox(fig)
+        fig.savefig(OUTPUT_DIR + TEMPERATURE_DIR + f'temperature_{timestamp}', bbox_inches=bbox)
+        str1 = f"Created output temperature map for {timestamp}"
+        logging.info(str1)
+    plt.close(fig)
+    return len(frame_indices)
+
+
+def tight_bbox(fig):
+    """ Bounding box (inches) of everything drawn in the figure, padded like bbox_inches='tight'
+
+    The layout of the maps does not change between frames, so this is computed once
+    instead of on every savefig. Extra padding leaves room for wider colorbar labels.
+    """
+    fig.canvas.draw()
+    bbox = fig.get_tightbbox(fig.canvas.get_renderer())
+    return bbox.padded(LAYOUT_PAD_INCHES)
+
+
+def render_maps(renderer, n_frames, workers):
+    """ Renders every frame with the given renderer, split in contiguous shards across workers
+
+    Returns:
+        float: seconds it took to render every frame
+    """
+    start_time = time.time()
+    if workers == 1:
+        renderer(range(n_frames))
+    else:
+        shards = [shard.tolist() for shard in np.array_split(np.arange(n_frames), workers)]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(renderer, shards))
+    return time.time() - start_time
+
+
+def create_output_maps(workers=1):
+    """ Creates a flow and a temperature map image for every frame of the h plane file
+
+    Args:
+        workers (int, optional): number of processes rendering maps in parallel
+    """
     start_time = time.time()
 
     str1 = f"File running from directory {os.getcwd()}"
@@ -34,115 +176,59 @@ def create_output_maps():
         msg = f"{str1}\n{str2}"
         logging.error(msg)
         sys.exit(0)
-    h_plane = HPlane_Si3dToPython(H_PLANE_PATH, DX)
-    n_rows, n_cols, n_frames = h_plane['Tg'].shape
+    # Reuses the gridded cache if another consumer already parsed this plane file
+    h_plane = CachedPlane(H_PLANE_PATH)
+    n_rows, n_cols = h_plane.grid_shape
+    n_frames = h_plane.n_frames
     str1 = "Found h plane file"
     str2 = f"Map dimensions (row, cols, n_frames) = {(n_rows, n_cols, n_frames)}"
     msg = f"{str1}\n{str2}"
     logging.info(msg)
 
+    # Grid every field before the workers start, so they only memory-map the cache
+    for name in ('u', 'v', 'w', 'T'):
+        h_plane.cube(name)
+
     # Create output directories if they don't exist
     if not os.path.isdir(OUTPUT_DIR):
         str1 = f"Output directory does not exist, creating folders {OUTPUT_DIR}"
         logging.info(str1)
         os.mkdir(OUTPUT_DIR)
     if not os.path.isdir(OUTPUT_DIR + "temperature/"):
-        os.mkdir(OUTPUT_DIR + "temperature/")
+        os.mkdir(OUTPUT_DIR + TEMPERATURE_DIR)
     if not os.path.isdir(OUTPUT_DIR + "flow/"):
-        os.mkdir(OUTPUT_DIR + "flow/")
+        os.mkdir(OUTPUT_DIR + FLOW_DIR)
 
 
     ##############################################################
     # Create flow maps in batch
     ##############################################################
-    FLOW_DIR = "flow/"
-    fig, ax = plt.subplots(1, 1)
-    text = ax.text(0.7, 0.882, "m/s", transform=fig.transFigure)
-    xg = h_plane['xg']
-    yg = h_plane['yg']
-    cbar = surface_flow = None
-    for idx, timestamp in enumerate(h_plane['time']):
-        # Remove previous plot for efficient rerender
-        if cbar is not None or surface_flow is not None:
-            cbar.remove()
-            surface_flow.remove()
-
-        u = h_plane['ug'][:, :, idx]
-        v = h_plane['vg'][:, :, idx]
-        w = h_plane['wg'][:, :, idx]
-        magnitude = (u**2 + v**2 + w**2)**0.5
-        surface_flow = ax.quiver(
-            xg, 
-            yg, 
-            u, 
-            v, 
-            magnitude, 
-            cmap='Spectral_r', 
-            scale=4, 
-            scale_units='inches', 
-            headwidth=3, 
-            headlength=5, 
-            headaxislength=10, 
-            width=0.008
-        )
-
-        cax = plt.axes([0.7, 0.125, 0.02, 0.75])
-        cbar = fig.colorbar(surface_flow, cax=cax)
-        cbar.ax.tick_params(labelsize=9)
-        
-        fig.suptitle(timestamp + ":00")
-        ax.set_aspect('equal')
-        ax.axis('off')
-
-        plt.savefig(OUTPUT_DIR + FLOW_DIR + f'flow_{timestamp}', bbox_inches='tight')
-        plt.cla()
-        str1 = f"Created output flow map for {timestamp}"
-        logging.info(str1)
-    plt.close()
+    elapsed = render_maps(render_flow_maps, n_frames, workers)
     str1 = f"Finished creating {n_frames} flow maps located in {OUTPUT_DIR + FLOW_DIR}"
-    logging.info(str1)
+    str2 = f"Rendered flow maps in {elapsed:.2f} seconds ({n_frames / elapsed:.2f} maps/s, {workers} workers)"
+    msg = f"{str1}\n{str2}"
+    logging.info(msg)
 
 
     ##############################################################
     # Create temperature maps in batch
     ##############################################################
-    TEMPERATURE_DIR = "temperature/"
-    fig, ax = plt.subplots(1, 1)
-    ax.text(0.7, 0.882, "° Celsius", transform=fig.transFigure)
-    xg = h_plane['xg']
-    yg = h_plane['yg']
-    cbar = temp_map = None
-    for idx, timestamp in enumerate(h_plane['time']):
-        z = h_plane['Tg'][:, :, idx]
-        # Remove previous plot for efficient rerender
-        if cbar is not None or temp_map is not None:
-            cbar.remove()
-            temp_map.remove()
-
-        temp_map = ax.pcolormesh(xg, yg, z, shading='gouraud', cmap='RdYlBu_r')
-
-        cax = plt.axes([0.7, 0.125, 0.02, 0.75])
-        cbar = fig.colorbar(temp_map, cax=cax)
-        cbar.ax.tick_params(labelsize=9)
-        
-        fig.suptitle(timestamp + ":00")
-        ax.set_aspect('equal')
-        ax.axis('off')
-
-        plt.savefig(OUTPUT_DIR + TEMPERATURE_DIR + f'temperature_{timestamp}', bbox_inches='tight')
-        plt.cla()
-        str1 = f"Created output temperature map for {timestamp}"
-        logging.info(str1)
+    elapsed = render_maps(render_temperature_maps, n_frames, workers)
     str1 = f"Finished creating {n_frames} temperature maps located in {OUTPUT_DIR + TEMPERATURE_DIR}"
-    logging.info(str1)
-    plt.close()
+    str2 = f"Rendered temperature maps in {elapsed:.2f} seconds ({n_frames / elapsed:.2f} maps/s, {workers} workers)"
+    msg = f"{str1}\n{str2}"
+    logging.info(msg)
 
     end_time = time.time()
     str1 = f"Completed all tasks in {(end_time - start_time):.2f} seconds"
-    str2 = f"Created {n_frames} flow maps from {h_plane['time'][0]} to {h_plane['time'][-1]}"
+    time_range = h_plane.time()
+    str2 = f"Created {n_frames} flow maps from {time_range[0]} to {time_range[-1]}"
     msg = f"{str1}\n{str2}"
     logging.info(msg)
 
 
 if __name__ == '__main__':
-    create_output_maps()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Creates flow and temperature maps from the h plane file")
+    parser.add_argument("--workers", type=int, default=1, help="number of processes rendering maps in parallel")
+    args = parser.parse_args()
+    create_output_maps(workers=args.workers)
@@ -0,0 +1,146 @@
+"""
+The purpose of this file is to create temperature rasters for the web frontend without
+matplotlib. Every frame of Tg is mapped to RGBA through a 256 entry lookup table of the
+'RdYlBu_r' colormap used by create_output_maps, land cells are transparent, and the image is
+encoded directly as a PNG with one pixel per grid cell (or `scale` x `scale` pixels).
+
+Running this file directly creates a tile for every frame of the h plane file:
+
+`python -m model.create_tiles`
+"""
+
+import os
+import sys
+import time
+import zlib
+import struct
+import logging
+import numpy as np
+from model.hplane_cache import CachedPlane
+
+##############################################################
+# User Config
+OUTPUT_DIR = "./model/outputs/"               # Output file directory
+H_PLANE_PATH = "./model/psi3d/plane_2"        # Path to model output file
+TILES_DIR = "tiles/temperature/"
+SCALE = 1                                     # Pixels per grid cell along each side
+COMPRESSION_LEVEL = 6                         # zlib level of the PNG, 1 is ~3x faster and ~15% larger
+##############################################################
+
+logFilename = "logs/s3_log.log"
+logging.basicConfig(
+    level=logging.INFO,  # all levels greater than or equal to info will be logged to this file
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    handlers=[
+        logging.FileHandler(logFilename, mode="w"),
+        logging.StreamHandler()
+    ]
+)
+
+# ColorBrewer RdYlBu anchors, as defined by matplotlib, reversed to get RdYlBu_r (blue is cold)
+RDYLBU_R = [
+    (0.19215686274509805, 0.21176470588235294, 0.58431372549019611),
+    (0.27058823529411763, 0.45882352941176469, 0.70588235294117652),
+    (0.45490196078431372, 0.67843137254901964, 0.81960784313725488),
+    (0.67058823529411760, 0.85098039215686272, 0.91372549019607840),
+    (0.87843137254901960, 0.95294117647058818, 0.97254901960784312),
+    (1.00000000000000000, 1.00000000000000000, 0.74901960784313726),
+    (0.99607843137254903, 0.87843137254901960, 0.56470588235294117),
+    (0.99215686274509807, 0.68235294117647061, 0.38039215686274508),
+    (0.95686274509803926, 0.42745098039215684, 0.26274509803921570),
+    (0.84313725490196079, 0.18823529411764706, 0.15294117647058825),
+    (0.64705882352941180, 0.00000000000000000, 0.14901960784313725),
+]
+
+
+def colormap_lut(anchors=RDYLBU_R, n_colors=256):
+    """ Returns an (n_colors, 4) uint8 RGBA table, linearly interpolated between evenly spaced anchors """
+    anchors = np.asarray(anchors)
+    position = np.linspace(0, 1, len(anchors))
+    samples = np.linspace(0, 1, n_colors)
+    lut = np.empty((n_colors, 4), dtype=np.uint8)
+    for channel in range(3):
+        lut[:, channel] = np.rint(255 * np.interp(samples, position, anchors[:, channel]))
+    lut[:, 3] = 255
+    return lut
+
+
+TEMPERATURE_LUT = colormap_lut()
+
+
+def to_rgba(values, lut=TEMPERATURE_LUT, vmin=None, vmax=None):
+    """ Maps a (rows, cols) grid to (rows, cols, 4) RGBA, NaN (land) cells are transparent
+
+    Args:
+        values (np.ndarray): grid of values, row 0 is the southern edge like in Tg
+        lut (np.ndarray, optional): (n, 4) uint8 color lookup table
+        vmin, vmax (float, optional): value range of the colormap, defaults to the range of the grid
+    """
+    water = ~np.isnan(values)
+    if not water.any():
+        # All-dry frame, the tile is fully transparent
+        return np.zeros(values.shape + (4,), dtype=np.uint8)
+    vmin = np.min(values[water]) if vmin is None else vmin
+    vmax = np.max(values[water]) if vmax is None else vmax
+
+    n_colors = len(lut)
+    scaled = (values - vmin) * ((n_colors - 1) / max(vmax - vmin, np.finfo(np.float32).eps))
+    index = np.clip(np.nan_to_num(scaled), 0, n_colors - 1).astype(np.uint8 if n_colors <= 256 else np.intp)
+
+    rgba = lut[index]
+    rgba[~water] = 0
+    # Images start at the top row, the grid starts at the southern edge
+    return rgba[::-1]
+
+
+def encode_png(rgba, compression_level=COMPRESSION_LEVEL):
+    """ Encodes a (rows, cols, 4) uint8 array as PNG bytes """
+    height, width, _ = rgba.shape
+    # Every scanline starts with its filter type, 0 (None)
+    scanlines = np.zeros((height, 1 + 4 * width), dtype=np.uint8)
+    scanlines[:, 1:] = rgba.reshape(height, 4 * width)
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)   # 8 bit RGBA
+    return b"".join([
+        b"\x89PNG\r\n\x1a\n",
+        chunk(b"IHDR", header),
+        chunk(b"IDAT", zlib.compress(scanlines.tobytes(), compression_level)),
+        chunk(b"IEND", b""),
+    ])
+
+
+def temperature_tile(t, scale=SCALE, vmin=None, vmax=None):
+    """ Returns the PNG bytes of a temperature grid """
+    rgba = to_rgba(t, vmin=vmin, vmax=vmax)
+    if scale > 1:
+        rgba = rgba.repeat(scale, axis=0).repeat(scale, axis=1)
+    return encode_png(rgba)
+
+
+def create_temperature_tiles():
+    start_time = time.time()
+
+    if not os.path.isfile(H_PLANE_PATH):
+        logging.error(f"[Error]: Could not find h plane file {H_PLANE_PATH}")
+        sys.exit(0)
+
+    h_plane = CachedPlane(H_PLANE_PATH)
+    os.makedirs(OUTPUT_DIR + TILES_DIR, exist_ok=True)
+
+    for timestamp, frame in h_plane.frames(('T',)):
+        with open(OUTPUT_DIR + TILES_DIR + f"temperature_{timestamp}.png", "wb") as file:
+            file.write(temperature_tile(frame['Tg']))
+        logging.debug(f"Created temperature tile for {timestamp}")
+
+    elapsed = time.time() - start_time
+    str1 = f"Finished creating {h_plane.n_frames} temperature tiles located in {OUTPUT_DIR + TILES_DIR}"
+    str2 = f"Completed in {elapsed:.2f} seconds ({h_plane.n_frames / elapsed:.2f} tiles/s)"
+    msg = f"{str1}\n{str2}"
+    logging.info(msg)
+
+
+if __name__ == '__main__':
+    create_temperature_tiles()
@@ -0,0 +1,150 @@
+"""
+The purpose of this file is to parse a plane file once and share the gridded result between
+every consumer of a run (create_output_binary, create_output_maps, ...).
+
+The first consumer grids every frame into a (frames, rows, cols) float32 .npy cube per field,
+stored in `<plane file>.cache/`. Later consumers memory-map those cubes instead of parsing and
+gridding the plane file again. The cache is keyed by the size, modification time and a hash of
+the beginning and end of the plane file, so a new simulation invalidates it.
+
+CachedPlane has the same interface as HPlaneReader (n_frames, grid_shape, grid, time,
+wet_cells, frames), so it can be used in its place.
+
+Example usage:
+
+```
+plane = CachedPlane("./model/psi3d/plane_2")
+for timestamp, frame in plane.frames(('u', 'v')):
+    uv = np.array([frame['ug'], frame['vg']])
+```
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import logging
+import numpy as np
+from contextlib import ExitStack
+from atomic_write import atomic_write
+from model.HPlane_Si3DtoPython import HPlaneReader
+
+CACHE_SUFFIX = ".cache"
+INDEX_FILE = "index.json"
+WET_CELLS_FILE = "wet_cells.npy"
+HASH_SAMPLE_BYTES = 1 << 20   # Bytes hashed at the beginning and end of the plane file
+
+
+def plane_key(h_plane_file):
+    """ Identifies the content of a plane file without reading all of it """
+    stat = os.stat(h_plane_file)
+    digest = hashlib.blake2b(digest_size=16)
+    with open(h_plane_file, "rb") as file:
+        digest.update(file.read(HASH_SAMPLE_BYTES))
+        file.seek(max(stat.st_size - HASH_SAMPLE_BYTES, 0))
+        digest.update(file.read(HASH_SAMPLE_BYTES))
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "hash": digest.hexdigest()}
+
+
+class CachedPlane:
+    """ Gridded view of a plane file, backed by memory-mapped .npy cubes on disk """
+
+    def __init__(self, h_plane_file, cache_dir=None):
+        self.path = h_plane_file
+        self.cache_dir = cache_dir or h_plane_file + CACHE_SUFFIX
+        self.__cubes = {}
+
+        key = plane_key(h_plane_file)
+        index_path = os.path.join(self.cache_dir, INDEX_FILE)
+        self.__index = None
+        if os.path.isfile(index_path):
+            with open(index_path, "r") as file:
+                self.__index = json.load(file)
+
+        if self.__index is None or self.__index["key"] != key:
+            logging.info(f"Creating gridded cache of {h_plane_file} in {self.cache_dir}")
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+            os.makedirs(self.cache_dir)
+
+            plane = HPlaneReader(h_plane_file)
+            np.save(os.path.join(self.cache_dir, WET_CELLS_FILE), plane.wet_cells())
+            self.__index = {
+                "key": key,
+                "time": plane.time(),
+                "grid_shape": list(plane.grid_shape),
+                "fields": [],
+            }
+            self.__save_index()
+        else:
+            logging.info(f"Using gridded cache of {h_plane_file} in {self.cache_dir}")
+
+    @property
+    def n_frames(self):
+        return len(self.__index["time"])
+
+    @property
+    def grid_shape(self):
+        return tuple(self.__index["grid_shape"])
+
+    def grid(self, dx):
+        """ Returns the x and y coordinates (m) of every grid cell """
+        n_rows, n_cols = self.grid_shape
+        xg, yg = np.meshgrid(np.arange(1, n_cols + 1), np.arange(1, n_rows + 1))
+        return xg * dx, yg * dx
+
+    def time(self):
+        return list(self.__index["time"])
+
+    def wet_cells(self):
+        return np.load(os.path.join(self.cache_dir, WET_CELLS_FILE))
+
+    def cube(self, name):
+        """ Returns the memory-mapped (frames, rows, cols) cube of a field, gridding it if needed """
+        if name not in self.__cubes:
+            self.__build([name])
+            self.__cubes[name] = np.load(self.__cube_path(name), mmap_mode='r')
+        return self.__cubes[name]
+
+    def frames(self, fields=('u', 'v', 'w', 'T'), start=0, dtype=np.float32, sparse=False):
+        """ Yields (timestamp, gridded frame) one frame at a time, see HPlaneReader.frames """
+        self.__build(fields)
+        cubes = {name: self.cube(name) for name in fields}
+        if sparse:
+            rows, cols = self.wet_cells()
+
+        timestamps = self.time()
+        for frame in range(start, self.n_frames):
+            gridded = {}
+            for name in fields:
+                if sparse:
+                    gridded[name] = cubes[name][frame][rows, cols].astype(dtype)
+                else:
+                    gridded[f"{name}g"] = np.array(cubes[name][frame], dtype=dtype)
+            yield timestamps[frame], gridded
+
+    def __build(self, fields):
+        # Grids every missing field in a single pass over the plane file
+        missing = [name for name in fields if name not in self.__index["fields"]]
+        if len(missing) == 0:
+            return
+
+        plane = HPlaneReader(self.path)
+        header = {'descr': np.dtype(np.float32).str, 'fortran_order': False, 'shape': (plane.n_frames,) + plane.grid_shape}
+        with ExitStack() as stack:
+            # Frames are appended to the .npy cubes in order, the cubes are complete once every frame is written
+            cubes = {name: stack.enter_context(atomic_write(self.__cube_path(name), "wb")) for name in missing}
+            for cube in cubes.values():
+                np.lib.format.write_array_header_1_0(cube, header)
+            for _, gridded in plane.frames(missing):
+                for name in missing:
+                    cubes[name].write(np.ascontiguousarray(gridded[f"{name}g"], dtype=np.float32).tobytes())
+
+        self.__index["fields"] += missing
+        self.__save_index()
+
+    def __cube_path(self, name):
+        return os.path.join(self.cache_dir, f"{name}g.npy")
+
+    def __save_index(self):
+        with atomic_write(os.path.join(self.cache_dir, INDEX_FILE), "w") as file:
+            json.dump(self.__index, file)
@@ -0,0 +1,153 @@
+"""
+The purpose of this file is to store every frame of a model run in a single archive
+instead of one .npy file per field and timestamp.
+
+The archive is a sequence of compressed chunks, one per field of every frame, written
+in time order. It is described by a json manifest with the same name:
+
+```
+{
+    "compression": "zlib",
+    "fields": {"flow": {"dtype": "<f4", "shape": [2, 174, 102], "encoding": {...}}, ...},
+    "frames": [{"time": "2022-05-09 02", "flow": [offset, length], ...}, ...]
+}
+```
+
+A client downloads the manifest once and fetches any frame with an HTTP byte range request
+(`Range: bytes=offset-(offset + length - 1)`) and decompresses it. Fields that were encoded
+(see encode in HPlane_Si3DtoPython.py) carry their encoding metadata in the manifest.
+
+Example usage:
+
+```
+with RunArchive("./outputs/archive/") as archive:
+    archive.add("2022-05-09 02", flow=uv, temperature=t)
+
+manifest = load_manifest("./outputs/archive/2022-05-09 02.json")
+t = read_frame("./outputs/archive/2022-05-09 02.bin", manifest, "2022-05-09 02", "temperature")
+```
+"""
+
+import os
+import bz2
+import json
+import lzma
+import zlib
+import numpy as np
+from atomic_write import atomic_write
+
+PARTIAL_NAME = "run.bin.part"  # Archive being written, renamed to `<first timestamp>.bin` by close
+
+# Lossless compressors available for the chunks, name -> (compress, decompress)
+COMPRESSORS = {
+    None: (lambda data: data, lambda data: data),
+    "zlib": (zlib.compress, zlib.decompress),
+    "bz2": (bz2.compress, bz2.decompress),
+    "lzma": (lzma.compress, lzma.decompress),
+}
+
+
+class RunArchive:
+    """ Writes frames sequentially into `<first timestamp>.bin` and its `.json` manifest """
+
+    def __init__(self, directory, compression="zlib", encodings=None):
+        """
+        Args:
+            directory (str): directory of the archive
+            compression (str, optional): name of the compressor in COMPRESSORS, None to disable
+            encodings (dict, optional): encoding metadata of each field, stored in the manifest
+        """
+        self.directory = directory
+        self.compress = COMPRESSORS[compression][0]
+        self.encodings = encodings or {}
+        self.manifest = {"compression": compression, "fields": {}, "frames": []}
+        self.archive_path = None
+        self.manifest_path = None
+
+        os.makedirs(directory, exist_ok=True)
+        self.__partial_path = os.path.join(directory, PARTIAL_NAME)
+        self.__file = open(self.__partial_path, "wb")
+        self.__offset = 0
+
+    def add(self, timestamp, **arrays):
+        """ Appends a frame to the archive
+
+        Args:
+            timestamp (str): time of the frame, formatted as 'YYYY-mm-dd HH'
+            arrays (np.ndarray): every field of the frame, keyed by its name
+        """
+        frame = {"time": timestamp}
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            if name not in self.manifest["fields"]:
+                self.manifest["fields"][name] = {
+                    "dtype": array.dtype.str,
+                    "shape": list(array.shape),
+                }
+                if name in self.encodings:
+                    self.manifest["fields"][name]["encoding"] = self.encodings[name]
+
+            chunk = self.compress(array.tobytes())
+            self.__file.write(chunk)
+            frame[name] = [self.__offset, len(chunk)]
+            self.__offset += len(chunk)
+        self.manifest["frames"].append(frame)
+
+    def close(self):
+        """ Finishes the archive and writes the manifest, returns the archive and manifest paths """
+        self.__file.close()
+        if len(self.manifest["frames"]) == 0:
+            os.remove(self.__partial_path)
+            return None, None
+
+        name = self.manifest["frames"][0]["time"]
+        self.archive_path = os.path.join(self.directory, f"{name}.bin")
+        self.manifest_path = os.path.join(self.directory, f"{name}.json")
+        os.replace(self.__partial_path, self.archive_path)
+        with atomic_write(self.manifest_path, "w") as file:
+            json.dump(self.manifest, file)
+        return self.archive_path, self.manifest_path
+
+    def discard(self):
+        """ Removes the partial archive, e.g. when the run failed """
+        self.__file.close()
+        if os.path.isfile(self.__partial_path):
+            os.remove(self.__partial_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.discard()
+        else:
+            self.close()
+
+
+def load_manifest(manifest_path):
+    with open(manifest_path, "r") as file:
+        return json.load(file)
+
+
+def read_frame(archive_path, manifest, timestamp, name):
+    """ Reads a single field of a frame, only the bytes of that chunk are read
+
+    Encoded fields are returned as stored, decode them with the metadata in
+    manifest["fields"][name]["encoding"].
+
+    Args:
+        archive_path (str): path to the archive
+        manifest (dict): manifest of the archive, see load_manifest
+        timestamp (str): time of the frame
+        name (str): name of the field, e.g. 'flow' or 'temperature'
+    """
+    frame = next(frame for frame in manifest["frames"] if frame["time"] == timestamp)
+    offset, length = frame[name]
+    with open(archive_path, "rb") as file:
+        file.seek(offset)
+        chunk = file.read(length)
+
+    field = manifest["fields"][name]
+    decompress = COMPRESSORS[manifest["compression"]][1]
+    array = np.frombuffer(decompress(chunk), dtype=field["dtype"])
+    return array.reshape(field["shape"])
@@ -35,6 +35,8 @@ def run_si3d(verbose=True):
 
     Arguments:
         verbose (bool): If true will print model output
+    Returns:
+        int: return code of the model, 0 if it finished successfully
     """
     # We need to change to cwd for model to properly read input file
     process = subprocess.Popen([MODEL_NAME], cwd=MODEL_DIR, stdout=subprocess.PIPE)
@@ -45,7 +47,7 @@ def run_si3d(verbose=True):
             if len(str1) >= 1:
                 str1 = str1[:-1]   
             logging.info(str1)
-    process.wait()
+    return process.wait()
     
 
 if __name__ == '__main__':
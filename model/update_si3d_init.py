@@ -92,13 +92,15 @@ def create_si3d_init(depth_profile, output_dir="./"):
             file.write(f"{m:>10.2f} {temperature:>10.4f} \n")
 
 
-def create_ctd_profile_from_api(output_dir, profile_date=None):
+def create_ctd_profile_from_api(output_dir, profile_date=None, ctd_profile=None):
     """ Creates a si3d init file using temperature  data made
         available through API's
         
         Args:
             output_dir (string): Output directory of si3d_init.txt
             profile_date (datetime): The date of the ctd profile. If None, defaults to today's date
+            ctd_profile (List[tuple], optional): profile already fetched on profile_date, e.g. by
+                DataRetrievalService.retrieve. Fetched from the API if None
     """
     format_date = lambda t: datetime.strftime(t.astimezone(tz=None), '%Y-%m-%d %H:%M %Z')
 
@@ -106,7 +108,8 @@ def create_ctd_profile_from_api(output_dir, profile_date=None):
         profile_date = datetime.now(timezone.utc)
     
     logging.info(f"Attempting to create ctd profile on {format_date(profile_date)} using API")
-    ctd_profile = get_model_ctd_profile(profile_date)
+    if ctd_profile is None:
+        ctd_profile = get_model_ctd_profile(profile_date)
 
     z, T = list(zip(*ctd_profile))            # extract depth and temperature 
     T = np.interp(CTD_LAYERS, z, T)           # interpolate temperature from layers
@@ -1,9 +1,18 @@
 import os
+import time
+import argparse
 import datetime
 import logging
+from typing import Dict, List
+from concurrent.futures import ThreadPoolExecutor
 import S3
+from sync_manifest import SyncManifest
 
-OUTPUT_DIRS = ["./outputs/flow", "./outputs/temperature"]
+OUTPUT_DIRS = ["./outputs/flow", "./outputs/temperature", "./outputs/archive"]  # Pyramid levels are found by outputDirs
+GRID_INDEX_PATH = "./outputs/grid_index.npy"  # Only written for sparse outputs
+ENCODING_PATH = "./outputs/encoding.json"     # Only written for encoded npy outputs
+UPLOAD_WORKERS = 8                            # Files uploaded concurrently, sharing one S3 client
+SYNC_MANIFEST_PATH = "./outputs/sync_manifest.json"  # Size, hash and ETag of every uploaded file
 
 logFilename = "logs/s3_log.log"
 logging.basicConfig(
@@ -15,40 +24,176 @@ logging.basicConfig(
     ]
 )
 
-def save_model_output() -> None:
-    today = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=8)
+def save_model_output(s3=None, uploaded=None, workers: int = UPLOAD_WORKERS, dryRun: bool = False) -> None:
+    """
+    Uploads new or changed recent model output files to S3 and updates contents.json
+
+    Files whose size and content hash match the last upload to the same key in the sync
+    manifest (SYNC_MANIFEST_PATH) are skipped, unless the object is no longer in the bucket
+    or its ETag changed.
 
-    s3 = S3.S3()  # s3 client with methods specific to our needs
+    Args:
+        s3 (S3.S3, optional): s3 client to reuse, a new one is created by default
+        uploaded (Set[str], optional): local file paths that were already uploaded during
+            this run (e.g. while si3d was running), these are skipped
+        workers (int, optional): number of files uploaded concurrently, 1 uploads them one at a time
+        dryRun (bool, optional): only print which files would be uploaded or skipped
+    """
+    if s3 is None:
+        s3 = S3.S3()  # s3 client with methods specific to our needs
+    if uploaded is None:
+        uploaded = set()
 
-    for localDir in OUTPUT_DIRS:
-        bucketSubDirectory: str = getLastDirectoryInPath(localDir)
+    manifest = SyncManifest(SYNC_MANIFEST_PATH)
+    for fileLocation in uploaded:
+        key = bucketKey(fileLocation)
+        manifest.record(key, fileLocation, contentEncoding=s3.contentEncoding(key))
+
+    fileLocations = []
+    for localDir in outputDirs():
+        if not os.path.isdir(localDir):
+            # Run archives are optional
+            continue
         for filename in os.listdir(localDir):
-            # Send file to backend server if file's timestamp is greater than today
-            # Parse timestamp from file
-            file_date = datetime.datetime.strptime(filename, "%Y-%m-%d %H.npy")
-            # Sets timezone to UTC without affecting other values
-            file_date = file_date.replace(tzinfo=datetime.timezone.utc)
-
-            if file_date > today:
-                # Read and send file
-                fileLocation = f"{localDir}/{filename}"
-                flow = (bucketSubDirectory == "flow")  # if false then file will be uploaded to temperature
-                successful, msg = s3.uploadToS3(fileLocation, filename, flow)
-                if successful:
-                    s3.prettyPrint(msg, title="File Upload Response: ")
-                else:
-                    logging.error("Upload Failed!")
+            fileLocation = f"{localDir}/{filename}"
+            if fileLocation in uploaded or not isRecent(filename):
+                continue
+            fileLocations.append(fileLocation)
+    # Sparse and encoded outputs share a single index and encoding description
+    fileLocations += [sharedPath for sharedPath in [GRID_INDEX_PATH, ENCODING_PATH] if os.path.isfile(sharedPath)]
+
+    # ETags of the objects in the bucket, including the shared files at its root
+    remoteETags = bucketETags(s3)
+    plan = []
+    skippedBytes = 0
+    for fileLocation in fileLocations:
+        key = bucketKey(fileLocation)
+        if manifest.isUnchanged(key, fileLocation, remoteETags.get(key), s3.contentEncoding(key)):
+            skippedBytes += os.path.getsize(fileLocation)
+            continue
+        plan.append((fileLocation, "changed" if key in remoteETags else "new"))
+
+    str1 = f"Sync plan: upload {len(plan)} files, skip {len(fileLocations) - len(plan)} unchanged files ({skippedBytes / 1e6:.2f} MB)"
+    if dryRun:
+        print(str1)
+        for fileLocation, reason in plan:
+            print(f"  {reason:<8} {fileLocation} -> {bucketKey(fileLocation)}")
+        return None
+    logging.info(str1)
+
+    # Each upload mostly waits on the network, threads overlap those round trips
+    startTime = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(lambda item: uploadFile(s3, item[0]), plan))
+    elapsed = time.perf_counter() - startTime
+
+    uploadedBytes = 0
+    remoteETags = bucketETags(s3)
+    for (fileLocation, _), successful in zip(plan, results):
+        if successful:
+            key = bucketKey(fileLocation)
+            manifest.record(key, fileLocation, remoteETags.get(key), s3.contentEncoding(key))
+            uploadedBytes += os.path.getsize(fileLocation)
+
+    nUploaded = sum(results)
+    str1 = f"Uploaded {nUploaded} of {len(plan)} files ({uploadedBytes / 1e6:.2f} MB) with {workers} workers"
+    str2 = f"Completed in {elapsed:.2f} seconds ({uploadedBytes / 1e6 / max(elapsed, 1e-9):.2f} MB/s, {nUploaded / max(elapsed, 1e-9):.1f} files/s)"
+    str3 = f"Saved {skippedBytes / 1e6:.2f} MB by skipping {len(fileLocations) - len(plan)} unchanged files"
+    msg = f"{str1}\n{str2}\n{str3}"
+    logging.info(msg)
     
     # update contents.json
     _, response = s3.updateContents()
     logging.info(response)
+
+    # Expired objects were deleted from the bucket
+    manifest.prune(bucketETags(s3))
+    manifest.save()
     return None
 
 
+def bucketETags(s3) -> Dict[str, str]:
+    # key -> ETag of every object in the bucket, from the cached listing kept up to date by the uploads and deletes
+    return {obj["Key"]: obj.get("ETag") for objs in s3.listBucket().values() for obj in objs}
+
+
+def uploadFile(s3, fileLocation: str) -> bool:
+    # uploads an output file or a shared file at the root of the bucket
+    if fileLocation in [GRID_INDEX_PATH, ENCODING_PATH]:
+        successful, _ = s3.uploadFile(fileLocation, os.path.basename(fileLocation))
+        return successful
+    return uploadModelOutput(s3, fileLocation)
+
+
+def uploadModelOutput(s3, fileLocation: str) -> bool:
+    """
+    Uploads a single flow, temperature or run archive file if it is recent enough
+
+    Returns:
+        bool: True if the file was uploaded
+    """
+    localDir, filename = os.path.split(fileLocation)
+    bucketSubDirectory: str = getLastDirectoryInPath(localDir)
+
+    if not isRecent(filename):
+        return False
+
+    # Read and send file
+    if bucketSubDirectory == "archive":
+        successful, msg = s3.uploadArchive(fileLocation, filename)
+    elif bucketSubDirectory in ["flow", "temperature"]:
+        flow = (bucketSubDirectory == "flow")  # if false then file will be uploaded to temperature
+        successful, msg = s3.uploadToS3(fileLocation, filename, flow)
+    else:
+        # Pyramid levels keep the name of their directory, e.g. flow_400m
+        successful, msg = s3.uploadFile(fileLocation, f"{bucketSubDirectory}/{filename}")
+    if successful:
+        s3.prettyPrint(msg, title="File Upload Response: ")
+    else:
+        logging.error("Upload Failed!")
+    return successful
+
+
+def outputDirs() -> List[str]:
+    # OUTPUT_DIRS and the pyramid levels written by create_output_binary, e.g. ./outputs/flow_400m
+    outputsDir = os.path.dirname(OUTPUT_DIRS[0])
+    levelDirs = []
+    if os.path.isdir(outputsDir):
+        levelDirs = sorted(f"{outputsDir}/{name}" for name in os.listdir(outputsDir) if S3.LEVEL_PREFIX.fullmatch(name))
+    return OUTPUT_DIRS + levelDirs
+
+
+def isRecent(filename: str) -> bool:
+    # True if the timestamp of an output file is within the last 8 days (or in the future)
+    today = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=8)
+
+    # Parse timestamp from file, other files (e.g. a partial run archive) are never recent
+    try:
+        file_date = datetime.datetime.strptime(os.path.splitext(filename)[0], "%Y-%m-%d %H")
+    except ValueError:
+        return False
+    # Sets timezone to UTC without affecting other values
+    file_date = file_date.replace(tzinfo=datetime.timezone.utc)
+
+    return file_date > today
+
+
+def bucketKey(fileLocation: str) -> str:
+    # key of a local output file in the bucket, e.g. "flow/2022-05-09 02.npy"
+    if fileLocation in [GRID_INDEX_PATH, ENCODING_PATH]:
+        return os.path.basename(fileLocation)
+    localDir, filename = os.path.split(fileLocation)
+    return f"{getLastDirectoryInPath(localDir)}/{filename}"
+
+
 def getLastDirectoryInPath(directoryPath: str) -> str:
     # returns the lowest directory in path
     lastDirectoryIndex: int = directoryPath.rfind("/")
     return directoryPath[lastDirectoryIndex + 1:]
 
 if __name__ == '__main__':
-    save_model_output()
+    parser = argparse.ArgumentParser(description="Uploads recent model outputs to S3")
+    parser.add_argument("--workers", type=int, default=UPLOAD_WORKERS, help="number of concurrent uploads")
+    parser.add_argument("--dry-run", action="store_true", help="print which files would be uploaded, upload nothing")
+    args = parser.parse_args()
+    save_model_output(workers=args.workers, dryRun=args.dry_run)
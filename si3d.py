@@ -10,13 +10,15 @@ Running this script will regularly perform this sequence of tasks
 import profile
 from dataretrieval.service import DataRetrievalService
 from model.run_model import run_si3d
-from model.create_output_binary import create_output_binary
+from model.create_output_binary import create_output_binary, H_PLANE_PATH
 from model.update_si3d_inp import update_si3d_inp
 from model.update_si3d_init import create_ctd_profile_from_node, create_ctd_profile_from_api
-from save_model_output import save_model_output
+from save_model_output import save_model_output, uploadModelOutput
+from S3 import S3
 import logging
 import datetime
 import os
+import threading
 import traceback
 
 logFilename = "logs/s3_log.log"
@@ -43,15 +45,15 @@ def run_si3d_workflow():
     logging.info(f"Simulation start date: {format_date(model_start_date)}")
 
     try:
-        # Retrieve data from various API's
-        drs.retrieve()
+        # Retrieve data from various API's, and the ctd profile along with it
+        drs.retrieve(ctd_date=model_start_date)
         drs.create_si3d_surfbc(f"{MODEL_DIR}/surfbc.txt", model_start_date)
 
         # Update si3d_inp.txt
         update_si3d_inp(model_start_date)
 
         try:
-            create_ctd_profile_from_api(MODEL_DIR, profile_date=model_start_date)
+            create_ctd_profile_from_api(MODEL_DIR, profile_date=model_start_date, ctd_profile=drs.ctd_profile)
         except:
             # Update si3d_init.txt using node 65, 135
             tf_path = f"{MODEL_DIR}tf65_135.txt"
@@ -59,14 +61,43 @@ def run_si3d_workflow():
 
             create_ctd_profile_from_node(tf_path, MODEL_DIR, profile_date=model_start_date)
 
-        # Run si3d model
-        run_si3d()
+        # Remove the plane file of the previous run, so it is not mistaken for new output
+        if os.path.isfile(H_PLANE_PATH):
+            os.remove(H_PLANE_PATH)
+
+        # Run si3d model in the background, keeping its return code or the error it raised
+        model_result = {}
+        def run_model():
+            try:
+                model_result["returncode"] = run_si3d()
+            except Exception as e:
+                model_result["error"] = e
+
+        model = threading.Thread(target=run_model)
+        model.start()
+
+        # Parse model output into Numpy array files and send them to S3 as the model writes them
+        s3 = S3()
+        uploaded = set()
+        def upload_frame(*file_paths):
+            for file_path in file_paths:
+                if uploadModelOutput(s3, file_path):
+                    uploaded.add(file_path)
 
-        # Parse model output into Numpy array files
-        create_output_binary()
-
-        # Send array files to S3
-        save_model_output()
+        try:
+            create_output_binary(follow=model.is_alive, on_frame=upload_frame)
+        finally:
+            # si3d keeps running if parsing or uploading failed, the instance must not be
+            # stopped under it
+            model.join()
+
+        if "error" in model_result:
+            raise model_result["error"]
+        if model_result["returncode"] != 0:
+            raise RuntimeError(f"si3d exited with return code {model_result['returncode']}")
+
+        # Send remaining array files to S3 and update contents.json
+        save_model_output(s3, uploaded)
 
         end = datetime.datetime.now(datetime.timezone.utc)
         logging.info(f"[DataRetrievalService]: Finished si3d workflow at {format_date(end)}")
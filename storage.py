@@ -0,0 +1,315 @@
+"""
+Storage backends the model outputs are published to.
+
+Every backend stores objects under '/' separated keys (e.g. "flow/2022-05-09 02.npy") and
+implements the same operations: upload, deleteMany, list, get and putIndex. S3Backend
+publishes to the S3 bucket read by the website. LocalBackend mirrors the bucket in a local
+directory, so the publish stage can be run and benchmarked without network or credentials.
+
+S3Backend can compress frames before uploading them (UPLOAD_COMPRESSION). The objects are
+stored with a Content-Encoding header, so browsers decode them transparently when fetching.
+zstd needs the zstandard package (`pip install zstandard`) and a recent browser, gzip works
+everywhere.
+
+The backend used by S3.S3 is selected with STORAGE_BACKEND:
+
+```
+backend = createBackend()             # STORAGE_BACKEND
+backend = LocalBackend("./bucket/")   # or explicitly
+backend.upload("./outputs/flow/2022-05-09 02.npy", "flow/2022-05-09 02.npy")
+```
+"""
+
+import io
+import os
+import gzip
+import hashlib
+import logging
+from typing import Dict, Iterator, List, Optional
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from atomic_write import atomic_write, PARTIAL_SUFFIX
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+##############################################################
+# User Config
+STORAGE_BACKEND = "s3"                  # "s3" bucket or "local" directory
+LOCAL_STORAGE_DIR = "./bucket/"         # Directory of the local backend
+BUCKET_NAME = "lake-tahoe-conditions"
+MULTIPART_THRESHOLD = 8 * 1024 * 1024   # Files larger than this are uploaded in parts
+MULTIPART_CHUNKSIZE = 8 * 1024 * 1024   # Size of each part
+MAX_CONCURRENCY = 4                     # Parts of a single file uploaded in parallel
+MAX_POOL_CONNECTIONS = 32               # HTTP connections shared by every thread using the client
+DELETE_BATCH_SIZE = 1000                # Keys removed per delete_objects request, at most 1000
+UPLOAD_COMPRESSION = None               # Content-Encoding of uploaded frames: None, "gzip" or "zstd"
+UPLOAD_COMPRESSION_LEVEL = None         # None for the default level of the codec, see CONTENT_ENCODINGS
+COMPRESSED_EXTENSIONS = (".npy",)       # Run archives are already compressed and read with range requests
+##############################################################
+
+
+def zstdCompress(data: bytes, level: int) -> bytes:
+    if zstandard is None:
+        raise ImportError("zstd compression needs the zstandard package, pip install zstandard")
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+def zstdDecompress(data: bytes) -> bytes:
+    if zstandard is None:
+        raise ImportError("zstd compression needs the zstandard package, pip install zstandard")
+    return zstandard.ZstdDecompressor().decompress(data)
+
+
+# Content-Encoding name -> (compress(data, level), decompress(data), default level)
+# gzip is written without a timestamp, so the same frame always has the same ETag
+CONTENT_ENCODINGS = {
+    "gzip": (lambda data, level: gzip.compress(data, level, mtime=0), gzip.decompress, 6),
+    "zstd": (zstdCompress, zstdDecompress, 3),
+}
+
+
+def md5ETag(localFilePath: str, multipartThreshold: Optional[int] = None, multipartChunksize: Optional[int] = None) -> str:
+    """
+    Returns the ETag S3 gives to a file, without asking S3
+
+    Single part uploads are tagged with the md5 of the file, multipart uploads (files of at least
+    multipartThreshold bytes) with the md5 of the md5s of every part followed by the number of parts.
+    """
+    size = os.path.getsize(localFilePath)
+    with open(localFilePath, "rb") as f:
+        if multipartThreshold is None or size < multipartThreshold:
+            return f'"{hashlib.md5(f.read()).hexdigest()}"'
+        partDigests = [hashlib.md5(part).digest() for part in iter(lambda: f.read(multipartChunksize), b"")]
+    return f'"{hashlib.md5(b"".join(partDigests)).hexdigest()}-{len(partDigests)}"'
+
+
+class StorageBackend:
+    """ Operations the publish stage needs from a storage, see S3Backend and LocalBackend """
+
+    name = None
+
+    def upload(self, localFilePath: str, key: str) -> None:
+        # stores a local file under key, raises if the upload failed
+        raise NotImplementedError
+
+    def deleteMany(self, keys: List[str]) -> Dict[str, str]:
+        # deletes every key, returns the error message of every key that could not be deleted
+        raise NotImplementedError
+
+    def list(self) -> Iterator[Dict]:
+        # yields {"Key", "Size", "ETag"} of every object, like list_objects_v2
+        raise NotImplementedError
+
+    def get(self, key: str) -> Optional[bytes]:
+        # returns the content of key, None if there is no such object
+        raise NotImplementedError
+
+    def putIndex(self, key: str, data: bytes) -> None:
+        # stores a json index (e.g. contents.json) that clients must not cache
+        raise NotImplementedError
+
+    def etag(self, localFilePath: str) -> str:
+        # ETag the object will have once localFilePath is uploaded
+        return md5ETag(localFilePath)
+
+    def contentEncoding(self, key: str) -> Optional[str]:
+        # Content-Encoding key is stored with, None if it is stored as is
+        return None
+
+
+class S3Backend(StorageBackend):
+    """ Objects in an S3 bucket. The client is thread safe, uploads can be made concurrently """
+
+    name = "s3"
+
+    def __init__(self, client=None, bucketName: str = BUCKET_NAME, transferConfig: TransferConfig = None,
+                 compression: Optional[str] = UPLOAD_COMPRESSION, compressionLevel: Optional[int] = UPLOAD_COMPRESSION_LEVEL) -> None:
+        """
+        Args:
+            client (optional): boto3 s3 client to use, e.g. one pointed at a local S3 stand-in
+                (endpoint_url of a moto server). By default a client is created from credentials.py
+            bucketName (str, optional): name of the bucket
+            transferConfig (TransferConfig, optional): multipart and concurrency settings of uploads
+            compression (str, optional): Content-Encoding of uploaded frames, one of CONTENT_ENCODINGS
+            compressionLevel (int, optional): level of the codec, its default level if None
+        """
+        if compression is not None and compression not in CONTENT_ENCODINGS:
+            raise ValueError(f"Unknown compression {compression}, expected one of {list(CONTENT_ENCODINGS)}")
+        if client is None:
+            import credentials
+            client = boto3.client(
+                service_name="s3",
+                region_name="us-west-2",
+                aws_access_key_id=credentials.aws_access_key_id,
+                aws_secret_access_key=credentials.aws_secret_access_key,
+                config=Config(max_pool_connections=MAX_POOL_CONNECTIONS)
+            )
+        if transferConfig is None:
+            transferConfig = TransferConfig(
+                multipart_threshold=MULTIPART_THRESHOLD,
+                multipart_chunksize=MULTIPART_CHUNKSIZE,
+                max_concurrency=MAX_CONCURRENCY,
+                use_threads=(MAX_CONCURRENCY > 1)
+            )
+        self.bucketName = bucketName
+        self.compression = compression
+        self.__client = client
+        self.__transferConfig = transferConfig
+        if compression is not None:
+            self.__compress = CONTENT_ENCODINGS[compression][0]
+            self.__compressionLevel = CONTENT_ENCODINGS[compression][2] if compressionLevel is None else compressionLevel
+        self.__etags = {}  # local file path -> ETag of its last compressed upload
+
+    def upload(self, localFilePath: str, key: str) -> None:
+        if self.contentEncoding(key) is None:
+            self.__client.upload_file(
+                localFilePath,  # path to the file that is to be uploaded in the local machine
+                self.bucketName,  # s3 bucket we will be adding the file to
+                Key=key,  # path in the s3 bucket to where the file should be stored
+                Config=self.__transferConfig
+            )
+            return
+
+        with open(localFilePath, "rb") as f:
+            data = f.read()
+        encoded = self.__compress(data, self.__compressionLevel)
+        self.__client.upload_fileobj(
+            io.BytesIO(encoded),
+            self.bucketName,
+            key,
+            ExtraArgs={
+                "ContentEncoding": self.compression,
+                "ContentType": "application/octet-stream",
+                "Metadata": {"uncompressed-size": str(len(data))},
+            },
+            Config=self.__transferConfig
+        )
+        # The ETag is the one of the compressed bytes, computed here to avoid compressing twice
+        self.__etags[localFilePath] = self.__bytesETag(encoded)
+
+    def deleteMany(self, keys: List[str]) -> Dict[str, str]:
+        errors = {}
+        for start in range(0, len(keys), DELETE_BATCH_SIZE):
+            batch = keys[start:start + DELETE_BATCH_SIZE]
+            # Quiet mode only reports the keys that failed
+            response = self.__client.delete_objects(
+                Bucket=self.bucketName,
+                Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True}
+            )
+            batchErrors = {error["Key"]: f"{error.get('Code')}: {error.get('Message')}" for error in response.get("Errors", [])}
+            errors.update(batchErrors)
+            logging.info(f"Deleted {len(batch) - len(batchErrors)} of {len(batch)} objects from {self.bucketName}")
+        return errors
+
+    def list(self) -> Iterator[Dict]:
+        paginator = self.__client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucketName):
+            yield from page.get("Contents", [])
+
+    def get(self, key: str) -> Optional[bytes]:
+        try:
+            response = self.__client.get_object(Bucket=self.bucketName, Key=key)
+        except self.__client.exceptions.NoSuchKey:
+            return None
+        data = response["Body"].read()
+        # Browsers decode Content-Encoding themselves, boto3 does not
+        contentEncoding = response.get("ContentEncoding")
+        if contentEncoding in CONTENT_ENCODINGS:
+            data = CONTENT_ENCODINGS[contentEncoding][1](data)
+        return data
+
+    def putIndex(self, key: str, data: bytes) -> None:
+        self.__client.put_object(
+            Bucket=self.bucketName,
+            Key=key,
+            Body=data,
+            ContentType="application/json",
+            CacheControl="no-cache"
+        )
+
+    def contentEncoding(self, key: str) -> Optional[str]:
+        if self.compression is None or not key.endswith(COMPRESSED_EXTENSIONS):
+            return None
+        return self.compression
+
+    def etag(self, localFilePath: str) -> str:
+        if localFilePath in self.__etags:
+            return self.__etags.pop(localFilePath)
+        return md5ETag(localFilePath, self.__transferConfig.multipart_threshold, self.__transferConfig.multipart_chunksize)
+
+    def __bytesETag(self, data: bytes) -> str:
+        # same as md5ETag, for data uploaded from memory
+        if len(data) < self.__transferConfig.multipart_threshold:
+            return f'"{hashlib.md5(data).hexdigest()}"'
+        chunkSize = self.__transferConfig.multipart_chunksize
+        partDigests = [hashlib.md5(data[start:start + chunkSize]).digest() for start in range(0, len(data), chunkSize)]
+        return f'"{hashlib.md5(b"".join(partDigests)).hexdigest()}-{len(partDigests)}"'
+
+
+class LocalBackend(StorageBackend):
+    """ Objects in a local directory, e.g. to measure publish throughput without network """
+
+    name = "local"
+
+    def __init__(self, root: str = LOCAL_STORAGE_DIR) -> None:
+        self.bucketName = root
+        self.__root = root
+        os.makedirs(root, exist_ok=True)
+
+    def upload(self, localFilePath: str, key: str) -> None:
+        with open(localFilePath, "rb") as f:
+            self.__write(key, f.read())
+
+    def deleteMany(self, keys: List[str]) -> Dict[str, str]:
+        errors = {}
+        for key in keys:
+            try:
+                os.remove(self.__path(key))
+            except OSError as e:
+                errors[key] = str(e)
+        logging.info(f"Deleted {len(keys) - len(errors)} of {len(keys)} objects from {self.__root}")
+        return errors
+
+    def list(self) -> Iterator[Dict]:
+        for directory, _, fileNames in sorted(os.walk(self.__root)):
+            for fileName in sorted(fileNames):
+                path = os.path.join(directory, fileName)
+                if path.endswith(PARTIAL_SUFFIX):
+                    continue
+                yield {
+                    "Key": os.path.relpath(path, self.__root).replace(os.sep, "/"),
+                    "Size": os.path.getsize(path),
+                    "ETag": md5ETag(path),
+                }
+
+    def get(self, key: str) -> Optional[bytes]:
+        if not os.path.isfile(self.__path(key)):
+            return None
+        with open(self.__path(key), "rb") as f:
+            return f.read()
+
+    def putIndex(self, key: str, data: bytes) -> None:
+        self.__write(key, data)
+
+    def __path(self, key: str) -> str:
+        return os.path.join(self.__root, *key.split("/"))
+
+    def __write(self, key: str, data: bytes) -> None:
+        # readers never see a partially written object
+        path = self.__path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with atomic_write(path, "wb") as f:
+            f.write(data)
+
+
+def createBackend(name: str = STORAGE_BACKEND) -> StorageBackend:
+    # backend selected by STORAGE_BACKEND
+    if name == "s3":
+        return S3Backend()
+    if name == "local":
+        return LocalBackend()
+    raise ValueError(f"Unknown storage backend {name}, expected 's3' or 'local'")
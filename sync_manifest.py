@@ -0,0 +1,90 @@
+import os
+import json
+import hashlib
+import logging
+from typing import Dict, Optional
+from atomic_write import atomic_write
+
+HASH_CHUNK_BYTES = 1 << 20   # Bytes read at a time when hashing a file
+
+
+def fileHash(localFilePath: str) -> str:
+    # hash of the content of a file, used to detect changed outputs
+    digest = hashlib.blake2b(digest_size=16)
+    with open(localFilePath, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class SyncManifest:
+    """
+    Local record of the files that were uploaded to the bucket, used to skip unchanged uploads
+
+    The manifest is a json file mapping every bucket key to the size and content hash of the
+    uploaded file, the ETag the bucket reported for it and the Content-Encoding it was uploaded with:
+
+    ```
+    {"flow/2022-05-09 02.npy": {"size": 142208, "hash": "5f0c...", "etag": "\\"9a3e...\\"", "contentEncoding": "gzip"}, ...}
+    ```
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.__entries: Dict[str, Dict] = {}
+        if os.path.isfile(path):
+            with open(path, "r") as f:
+                self.__entries = json.load(f)
+        return
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def isUnchanged(self, key: str, localFilePath: str, remoteETag: Optional[str],
+                    contentEncoding: Optional[str] = None) -> bool:
+        """
+        Returns True if localFilePath was already uploaded to key and the object is still in the bucket
+
+        Args:
+            key (str): key of the object in the bucket
+            localFilePath (str): file that would be uploaded to key
+            remoteETag (str, optional): ETag of key in the bucket, None if the bucket has no such object
+            contentEncoding (str, optional): Content-Encoding the file would be uploaded with now
+        """
+        entry = self.__entries.get(key)
+        if entry is None or remoteETag is None:
+            return False
+        if entry.get("etag") is not None and entry["etag"] != remoteETag:
+            # Replaced or rewritten by someone else since our upload
+            return False
+        if entry.get("contentEncoding") != contentEncoding:
+            # Uploaded with another compression, e.g. UPLOAD_COMPRESSION was changed
+            return False
+        if entry["size"] != os.path.getsize(localFilePath):
+            return False
+        if entry["hash"] != fileHash(localFilePath):
+            return False
+
+        # ETags are only known once the bucket is listed after the upload
+        entry["etag"] = remoteETag
+        return True
+
+    def record(self, key: str, localFilePath: str, etag: Optional[str] = None,
+               contentEncoding: Optional[str] = None) -> None:
+        # remembers that localFilePath was uploaded to key, with the given Content-Encoding
+        self.__entries[key] = {
+            "size": os.path.getsize(localFilePath),
+            "hash": fileHash(localFilePath),
+            "etag": etag,
+            "contentEncoding": contentEncoding,
+        }
+
+    def prune(self, keys) -> None:
+        # forgets every key that is not in keys, e.g. objects deleted from the bucket
+        keys = set(keys)
+        self.__entries = {key: entry for key, entry in self.__entries.items() if key in keys}
+
+    def save(self) -> None:
+        with atomic_write(self.path, "w") as f:
+            json.dump(self.__entries, f)
+        logging.info(f"Saved sync manifest {self.path} with {len(self.__entries)} objects")
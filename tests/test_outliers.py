@@ -0,0 +1,157 @@
+"""
+Compares aws.remove_outliers with the column by column filtering it replaced.
+
+The column by column filtering replaced deviating values and values at the bounds with chained
+`df[feature].where(..., inplace=True)` calls. Those only update df on pandas versions without
+copy-on-write: on pandas 3 they are no-ops, and only the median filtering and the clipping were
+applied. remove_outliers runs every documented step on every pandas version, so on pandas 3 its
+output differs from the column by column filtering.
+
+Run from the root of the repository:
+
+`python -m pytest tests`
+"""
+
+from dataretrieval.aws import ATTR_BOUNDS, remove_outliers
+import numpy as np
+import pandas as pd
+import warnings
+import pytest
+
+PANDAS_COPY_ON_WRITE = int(pd.__version__.split(".")[0]) >= 3
+
+
+def median_filtering(df):
+    for feature in df.columns:
+        if feature == 'time':
+            continue
+        df[feature] = df[feature].rolling(window=5, min_periods=1, center=True).median()
+
+
+def clip(df):
+    for feature, (lo, hi) in ATTR_BOUNDS.items():
+        if feature in df.columns:
+            df[feature] = np.clip(df[feature], lo, hi)
+
+
+def reference_remove_outliers(df):
+    """ The column by column filtering, with explicit assignments instead of chained inplace calls """
+    median_filtering(df)
+    clip(df)
+
+    for feature in df.columns:
+        if feature == 'time':
+            continue
+
+        mean = df[feature].rolling(window=100, center=True, min_periods=1).mean()
+        std = df[feature].rolling(window=100, center=True, min_periods=1).std()
+        std[0] = 0
+        lo = mean - 3 * std
+        hi = mean + 3 * std
+
+        df[feature] = df[feature].where(lo < df[feature], mean)
+        df[feature] = df[feature].where(df[feature] < hi, mean)
+
+    for feature, (lo, hi) in ATTR_BOUNDS.items():
+        if feature == 'shortwave' or feature not in df.columns:
+            continue
+        mean = df[feature].rolling(window=100, center=True, min_periods=1).mean()
+        df[feature] = df[feature].where(df[feature] != hi, mean)
+        df[feature] = df[feature].where(df[feature] != lo, mean)
+
+    median_filtering(df)
+
+
+def chained_remove_outliers(df):
+    """ The column by column filtering, as it was written """
+    median_filtering(df)
+    clip(df)
+
+    # pandas 3 warns that the chained calls below do not update df
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        for feature in df.columns:
+            if feature == 'time':
+                continue
+
+            mean = df[feature].rolling(window=100, center=True, min_periods=1).mean()
+            std = df[feature].rolling(window=100, center=True, min_periods=1).std()
+            std[0] = 0
+            lo = mean - 3 * std
+            hi = mean + 3 * std
+
+            df[feature].where(lo < df[feature], mean, inplace=True)
+            df[feature].where(df[feature] < hi, mean, inplace=True)
+
+        for feature, (lo, hi) in ATTR_BOUNDS.items():
+            if feature == 'shortwave' or feature not in df.columns:
+                continue
+            mean = df[feature].rolling(window=100, center=True, min_periods=1).mean()
+            df[feature].where(df[feature] != hi, mean, inplace=True)
+            df[feature].where(df[feature] != lo, mean, inplace=True)
+
+    median_filtering(df)
+
+
+def filtered(filter, df):
+    df = df.copy()
+    filter(df)
+    return df
+
+
+@pytest.fixture(scope="module")
+def features():
+    """ 10 days of 10 minute station data with spikes, values out of bounds and values sitting at
+    the bounds, in the columns of get_model_historical_data
+    """
+    n = 10 * 24 * 6
+    rng = np.random.default_rng(1)
+    day = np.sin(2 * np.pi * np.arange(n) / (24 * 6))
+    df = pd.DataFrame({
+        "time": pd.date_range("2022-01-01", periods=n, freq="10min", tz="UTC"),
+        "shortwave": np.maximum(0, 810 * day),
+        "air temp": 5 + 6 * day + rng.normal(0, 0.5, n),
+        "atmospheric pressure": 81600 + 300 * day + rng.normal(0, 50, n),
+        "relative humidity": 0.45 - 0.15 * day + rng.normal(0, 0.005, n),
+        "longwave": 260 + 30 * day + rng.normal(0, 0.5, n),
+        "wind speed": 4 + 2 * day + rng.normal(0, 0.5, n),
+        "wind direction": (180 + 120 * day) % 360,
+    })
+    for feature in df.columns[1:]:
+        rows = rng.choice(n, size=n // 100, replace=False)
+        df.loc[rows, feature] += rng.normal(0, 20, size=len(rows)) * df[feature].std()
+        lo, hi = ATTR_BOUNDS[feature]
+        df.loc[rng.choice(n, size=n // 200, replace=False), feature] = lo
+        df.loc[rng.choice(n, size=n // 500, replace=False), feature] = hi + 1
+    # A calm day, the wind speed sits at its lower bound
+    df.loc[n // 3:n // 3 + 24 * 6, "wind speed"] = 0.0
+    return df
+
+
+def test_remove_outliers_runs_every_step(features):
+    engine = filtered(remove_outliers, features)
+    reference = filtered(reference_remove_outliers, features)
+
+    assert not engine.equals(features)
+    pd.testing.assert_frame_equal(engine, reference, check_exact=True)
+
+
+def test_remove_outliers_against_chained_filtering(features):
+    engine = filtered(remove_outliers, features)
+    chained = filtered(chained_remove_outliers, features)
+
+    if not PANDAS_COPY_ON_WRITE:
+        pd.testing.assert_frame_equal(engine, chained, check_exact=True)
+        return
+
+    # Only the median filtering and the clipping were applied
+    clipped_only = features.copy()
+    median_filtering(clipped_only)
+    clip(clipped_only)
+    median_filtering(clipped_only)
+    pd.testing.assert_frame_equal(chained, clipped_only, check_exact=True)
+
+    # remove_outliers also replaces the spikes and the values at the bounds
+    assert not engine.equals(chained)
+    wind_speed_lo = ATTR_BOUNDS["wind speed"][0]
+    assert (chained["wind speed"] == wind_speed_lo).sum() > (engine["wind speed"] == wind_speed_lo).sum()
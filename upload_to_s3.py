@@ -14,9 +14,10 @@ if __name__ == "__main__":
         print(f"Error: Could not find file '{file_path}'")
         sys.exit(0)
     
-    from S3 import S3
-    s3 = S3()
-    s3._S3__insertToBucket(file_path, file_name)
+    # STORAGE_BACKEND in storage.py selects the S3 bucket or a local directory
+    from storage import createBackend
+    backend = createBackend()
+    backend.upload(file_path, file_name)
 
-    print(f"Successfully uploaded '{file_name}' to S3")
+    print(f"Successfully uploaded '{file_name}' to {backend.bucketName}")
     print("Done!")